@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+
+import aiohttp
+import orjson
+
+import weibo_scraper_settings
+import weibo_scraper_utils
+import weibo_scraper_with_proxy_pool as scraper
+from weibo_scraper_metrics import ROWS
+from weibo_scraper_mock import MockConfig, serve_mock_servers
+from weibo_scraper_utils import extracted_text_from_html, get_timestamp_from_date_string
+from weibo_scraper_with_proxy_pool import get_rows_from_mobile_data, get_detail_href, parse_timeline_page
+
+
+SAMPLE_PAGE_FILE = "./benchmark_data/sample_timeline_page.json"
+# a getIndex timeline page, replace it with a recorded page to benchmark on real data
+
+REGRESSION_THRESHOLD = 1.2
+# a benchmark is reported as a regression if it is this many times slower than the baseline
+
+
+def micro_benchmarks(page_text):
+    """
+    DESCRIPTION:
+        the row transform micro-benchmarks, each one is run over all the cards of the sample page
+
+    OUTPUT:
+        dict of benchmark name: (function to time, amount of items it handles)
+    """
+    page_json = orjson.loads(page_text)
+    cards = page_json["data"]["cards"]
+    mblogs = [card["mblog"] for card in cards]
+    texts = [mblog["text"] for mblog in mblogs]
+    date_strings = [mblog["created_at"] for mblog in mblogs]
+    old_text_pattern = r'(&[a-z]*?;)|(<[^>]*>)'
+    old_href_pattern = r'<a\s+href="([^"]+)">全文<\/a>$'
+
+    return {
+        "page json parse": (lambda: orjson.loads(page_text), 1),
+        "timeline page parse": (lambda: parse_timeline_page(page_text), 1),
+        "rows batch": (lambda: get_rows_from_mobile_data(mblogs), len(mblogs)),
+        "html to text": (lambda: [extracted_text_from_html(text) for text in texts], len(texts)),
+        "html to text, uncompiled regex": (lambda: [re.sub(old_text_pattern, '', text) for text in texts], len(texts)),
+        "created_at parse": (lambda: [get_timestamp_from_date_string(date_string) for date_string in date_strings], len(date_strings)),
+        "created_at strptime": (lambda: [int(datetime.strptime(date_string, "%a %b %d %H:%M:%S %z %Y").timestamp())
+                                         for date_string in date_strings], len(date_strings)),
+        "detail href": (lambda: [get_detail_href(card) for card in cards], len(cards)),
+        "detail href, uncompiled regex": (lambda: [re.search(old_href_pattern, text) for text in texts], len(texts)),
+    }
+
+
+def run_micro_benchmarks(page_file, number, repeat):
+    """
+    OUTPUT:
+        dict of benchmark name: best nanoseconds per item
+    """
+    with open(page_file, 'rb') as file:
+        page_text = file.read()
+    results = {}
+    for name, (function, item_count) in micro_benchmarks(page_text).items():
+        best = min(timeit.repeat(function, number=number, repeat=repeat))
+        results[name] = best / number / item_count * 1e9
+    return results
+
+
+async def drive_initiator(base_url, proxy_list_url, stats_url, user_count, worker_size, output_folder, offload_processes=0):
+    """
+    DESCRIPTION:
+        run a scraper engine with one crawl job against the mock servers and measure it
+
+    OUTPUT:
+        dict of metric name: value
+    """
+    scraper.MWEIBO_BASE_URL = base_url
+    weibo_scraper_settings.PROXY_POOL_URL = proxy_list_url
+    scraper.WORKER_SIZE = worker_size
+    scraper.OFFLOAD_PROCESSES = offload_processes
+    scraper.STATE_DB_FILE = os.path.join(output_folder, "weibo_state.db")
+    scraper.METRICS_PORT = None
+    scraper.METRICS_SNAPSHOT_NAME = None
+    # the mock proxies listen on new ports every run
+    scraper.PROXY_CACHE_FILE = None
+    weibo_scraper_utils.LOG_OUTPUT_FOLDER = output_folder + os.sep
+
+    # time every request as the workers see it, retries included
+    latencies = []
+    original_proxy_fetcher = scraper.proxy_fetcher
+    async def timed_proxy_fetcher(session, url, retry=scraper.FETCHER_RETRY, proxy=None, **kwargs):
+        if retry != scraper.FETCHER_RETRY:
+            return await original_proxy_fetcher(session, url, retry=retry, proxy=proxy, **kwargs)
+        start_time = time.monotonic()
+        result = await original_proxy_fetcher(session, url, retry=retry, proxy=proxy, **kwargs)
+        latencies.append(time.monotonic() - start_time)
+        return result
+    scraper.proxy_fetcher = timed_proxy_fetcher
+
+    async def uid_source():
+        for uid in range(1000, 1000 + user_count):
+            yield uid
+
+    start_time = time.monotonic()
+    engine = scraper.ScraperEngine()
+    await engine.start()
+    job = engine.add_job(uid_source(), os.path.join(output_folder, "weibo_bench"), worker_size)
+    first_row_time = None
+    while not job.done():
+        await asyncio.sleep(0.05)
+        if first_row_time is None and ROWS.total():
+            first_row_time = time.monotonic() - start_time
+    elapsed = time.monotonic() - start_time
+    max_loop_lag = scraper._LAG_MONITOR.max_lag if scraper._LAG_MONITOR else 0
+    try:
+        await engine.stop()
+    finally:
+        scraper.proxy_fetcher = original_proxy_fetcher
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(stats_url) as resp:
+            served = orjson.loads(await resp.read())
+
+    latencies.sort()
+    return {
+        "elapsed s": elapsed,
+        "first row s": first_row_time or elapsed,
+        "users/s": user_count / elapsed,
+        "rows/s": ROWS.total() / elapsed,
+        "pages/s": served.get("timeline page", 0) / elapsed,
+        "detail pages/s": served.get("detail page", 0) / elapsed,
+        "requests": len(latencies),
+        "p50 latency s": latencies[len(latencies) // 2] if latencies else 0,
+        "p99 latency s": latencies[int(len(latencies) * 0.99)] if latencies else 0,
+        "max loop lag s": max_loop_lag,
+        "peak rss MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_load_benchmark(config, user_count, worker_size, offload_processes=0):
+    """
+    DESCRIPTION:
+        start the mock servers in another process so they do not share the event loop with the scraper,
+        then drive initiator against them. The output and logs go to a temporary folder.
+    """
+    parent_connection, child_connection = multiprocessing.Pipe()
+    mock_process = multiprocessing.Process(target=serve_mock_servers, args=(config, child_connection), daemon=True)
+    mock_process.start()
+    try:
+        if not parent_connection.poll(30):
+            raise RuntimeError("the mock servers did not start")
+        base_url, proxy_list_url, stats_url = parent_connection.recv()
+        with tempfile.TemporaryDirectory() as output_folder, open(os.devnull, 'w') as devnull:
+            # the workers print when they get off work
+            with contextlib.redirect_stdout(devnull):
+                return asyncio.run(drive_initiator(base_url, proxy_list_url, stats_url, user_count, worker_size, output_folder,
+                                                   offload_processes))
+    finally:
+        mock_process.terminate()
+        mock_process.join()
+
+
+# for these results higher is better, for the others lower is better
+_HIGHER_IS_BETTER = {"users/s", "rows/s", "pages/s", "detail pages/s"}
+
+
+def print_results(results, baseline=None, unit="ns/item"):
+    regressions = []
+    for name, value in results.items():
+        if unit:
+            line = f"{name:<34}{value:>12.0f} {unit}"
+        else:
+            line = f"{name:<34}{value:>12.3f}"
+        if baseline and baseline.get(name):
+            ratio = value / baseline[name]
+            line += f"{ratio:>8.2f}x baseline"
+            if ratio > REGRESSION_THRESHOLD and name not in _HIGHER_IS_BETTER or \
+                    ratio < 1 / REGRESSION_THRESHOLD and name in _HIGHER_IS_BETTER:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmarks of the weibo scraper")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    micro_parser = subparsers.add_parser("micro", help="row transform micro-benchmarks on a sample timeline page")
+    micro_parser.add_argument("--page", default=SAMPLE_PAGE_FILE, help="getIndex timeline page json")
+    micro_parser.add_argument("--number", type=int, default=200, help="calls per timing")
+    micro_parser.add_argument("--repeat", type=int, default=5, help="timings, the best one is kept")
+    micro_parser.add_argument("--save", help="save the results as a baseline json file")
+    micro_parser.add_argument("--compare", help="compare the results with a baseline json file, exit 1 on regression")
+
+    load_parser = subparsers.add_parser("load", help="end-to-end run of initiator against a local mock m.weibo.cn and mock proxies")
+    load_parser.add_argument("--users", type=int, default=200)
+    load_parser.add_argument("--workers", type=int, default=weibo_scraper_settings.WORKER_SIZE)
+    load_parser.add_argument("--offload-processes", type=int, default=weibo_scraper_settings.OFFLOAD_PROCESSES,
+                             help="parse the pages in this amount of processes while the event loop lags")
+    load_parser.add_argument("--proxies", type=int, default=20)
+    load_parser.add_argument("--proxy-latency", type=float, default=0.05, help="mean seconds a proxy adds to a request")
+    load_parser.add_argument("--proxy-failure-rate", type=float, default=0.02)
+    load_parser.add_argument("--proxy-throttle-rate", type=float, default=0.01)
+    load_parser.add_argument("--bad-proxy-ratio", type=float, default=0.2, help="share of slow and flaky proxies")
+    load_parser.add_argument("--long-text-ratio", type=float, default=0.2)
+    load_parser.add_argument("--posts-scale", type=int, default=10, help="minimum post count of a user")
+    load_parser.add_argument("--max-posts", type=int, default=2000)
+    load_parser.add_argument("--seed", type=int, default=0)
+    load_parser.add_argument("--save", help="save the results as a baseline json file")
+    load_parser.add_argument("--compare", help="compare the results with a baseline json file, exit 1 on regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "micro":
+        results = run_micro_benchmarks(args.page, args.number, args.repeat)
+        unit = "ns/item"
+    else:
+        config = MockConfig(proxy_count=args.proxies, proxy_latency=args.proxy_latency,
+                            proxy_failure_rate=args.proxy_failure_rate, proxy_throttle_rate=args.proxy_throttle_rate,
+                            bad_proxy_ratio=args.bad_proxy_ratio, posts_scale=args.posts_scale, max_posts=args.max_posts,
+                            long_text_ratio=args.long_text_ratio, seed=args.seed)
+        results = run_load_benchmark(config, args.users, args.workers, args.offload_processes)
+        unit = None
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'rb') as file:
+            baseline = orjson.loads(file.read())
+    regressions = print_results(results, baseline, unit)
+    if args.save:
+        with open(args.save, 'wb') as file:
+            file.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    if regressions:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
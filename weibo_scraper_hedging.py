@@ -0,0 +1,60 @@
+import collections
+
+from weibo_scraper_settings import HEDGE_QUANTILE, HEDGE_BUDGET, HEDGE_BURST, HEDGE_WINDOW, HEDGE_MIN_SAMPLES
+
+
+class HedgePolicy:
+    """
+    Description:
+        This decides when a request through a proxy is hedged, namely sent again through a second proxy.
+        A request is hedged when it has not answered after the HEDGE_QUANTILE of the latest HEDGE_WINDOW
+        response times of its endpoint, eg. the p95 of the timeline pages.
+        Every request earns HEDGE_BUDGET hedges, up to HEDGE_BURST saved, and every hedge spends one,
+        so the hedges add at most HEDGE_BUDGET extra requests per request.
+
+    DATA STRUCTURE:
+        _latencies, # dict of endpoint: deque of the latest response times
+        _thresholds, # dict of endpoint: the quantile, recomputed every HEDGE_MIN_SAMPLES responses
+        _tokens # hedges that can be sent right now
+    """
+
+    def __init__(self):
+        self._latencies = {}
+        self._thresholds = {}
+        self._since_update = collections.Counter()
+        self._tokens = 0
+
+    def observe(self, endpoint, latency):
+        latencies = self._latencies.get(endpoint)
+        if latencies is None:
+            latencies = self._latencies[endpoint] = collections.deque(maxlen=HEDGE_WINDOW)
+        latencies.append(latency)
+        self._since_update[endpoint] += 1
+        # sorting the window on every response would cost more than the hedges save
+        if len(latencies) >= HEDGE_MIN_SAMPLES and self._since_update[endpoint] >= HEDGE_MIN_SAMPLES:
+            ordered = sorted(latencies)
+            self._thresholds[endpoint] = ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_QUANTILE))]
+            self._since_update[endpoint] = 0
+
+    def delay(self, endpoint):
+        """
+        DESCRIPTION:
+            earn the hedge budget of a request to endpoint
+
+        OUTPUT:
+            seconds to wait before hedging it, None if it is not hedged
+        """
+        if not HEDGE_BUDGET:
+            return None
+        self._tokens = min(HEDGE_BURST, self._tokens + HEDGE_BUDGET)
+        return self._thresholds.get(endpoint)
+
+    def try_spend(self):
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        # the hedge was not sent after all, eg. there was no idle proxy
+        self._tokens = min(HEDGE_BURST, self._tokens + 1)
@@ -0,0 +1,58 @@
+import asyncio
+
+
+class SessionIdentity:
+    """
+    DESCRIPTION:
+        a warmed up cookie session bound to the proxy it was warmed up through
+
+    DATA STRUCTURE:
+        session, # aiohttp.ClientSession with its own cookie jar on the shared connector
+        proxy, # the proxy the cookies were obtained through, leased from the proxy registry
+        uses # the amount of users scraped with it
+    """
+    __slots__ = ("session", "proxy", "uses")
+
+    def __init__(self, session, proxy):
+        self.session = session
+        self.proxy = proxy
+        self.uses = 0
+
+
+class IdentityPool:
+    """
+    Description:
+        This is the pool of warmed up session identities waiting for a worker.
+        The identity warmers put identities in it and the workers check them out, so the warm up requests
+        are not on the path of a user. A worker keeps its identity for many users, and retires it
+        when it is throttled, its proxy changes or it has been used IDENTITY_MAX_USES times.
+        The pool holds at most size identities, a warmer waits when it is full,
+        so the proxies of the waiting identities are not leased for nothing.
+    """
+
+    def __init__(self, size):
+        self._queue = asyncio.Queue(size)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def put(self, identity):
+        await self._queue.put(identity)
+
+    async def checkout(self):
+        return await self._queue.get()
+
+    async def close(self):
+        """
+        DESCRIPTION:
+            close the sessions of the identities left in the pool
+
+        OUTPUT:
+            the proxies of the closed identities, to be given back to the registry
+        """
+        proxies = []
+        while not self._queue.empty():
+            identity = self._queue.get_nowait()
+            await identity.session.close()
+            proxies.append(identity.proxy)
+        return proxies
@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import collections
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from weibo_scraper_settings import JOB_DB_FILE, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_CLAIM_SIZE, JOB_POLL_INTERVAL, \
+    UID_CHUNK_SIZE
+
+
+JobResult = collections.namedtuple("JobResult", ["uid", "error"])
+# put to the results queue by a worker when a user is finished, error is None if the user is done
+
+
+class JobTable:
+    """
+    Description:
+        This is the durable table of the uids to crawl, kept in a sqlite database.
+        Every uid is claimed with a lease that expires after lease_seconds, and marked done or failed when it is finished.
+        A uid whose lease expired, eg. because its process died, or that failed less than JOB_MAX_ATTEMPTS times
+        is handed out again. Several processes, also on several hosts sharing a filesystem with working file locks,
+        can pull from one table: claims run in an immediate transaction, so no uid is claimed twice.
+        The table uses the rollback journal, as the write ahead log needs shared memory, which the processes of other hosts do not see.
+        Every call is a short transaction of its own, so the other processes are never locked out for long.
+        A call may wait up to 60 seconds for the lock of another process, so the scraper makes the calls with asyncio.to_thread,
+        and the connection is shared by the threads one call at a time.
+
+    Tables:
+        jobs:
+            uid,
+            status, # pending, leased, done or failed
+            attempts, # the amount of times the uid has been claimed
+            owner, # host:pid of the process holding the lease
+            lease_expires, # time.time() when the lease expires
+            error, # why the last attempt failed
+            updated # time.time() of the last change
+    """
+
+    def __init__(self, db_file, lease_seconds=JOB_LEASE_SECONDS, owner=None):
+        # transactions are handled explicitly
+        self.conn = sqlite3.connect(db_file, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        # also turns a table of an older version back from the write ahead log
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (uid INTEGER PRIMARY KEY, status TEXT NOT NULL DEFAULT 'pending', "
+                          "attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, lease_expires REAL, error TEXT, updated REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, attempts)")
+        self.lease_seconds = lease_seconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+
+    def add_uids(self, uids):
+        """
+        DESCRIPTION:
+            add uids as pending jobs, uids that are already in the table keep their status
+        """
+        now = time.time()
+        with self._transaction():
+            self.conn.executemany("INSERT OR IGNORE INTO jobs (uid, updated) VALUES (?, ?)", ((uid, now) for uid in uids))
+
+    def claim(self, count):
+        """
+        DESCRIPTION:
+            lease up to count uids to this process, the uids claimed the fewest times first
+
+        OUTPUT:
+            list of uids
+        """
+        now = time.time()
+        with self._transaction():
+            uids = [uid for uid, in self.conn.execute(
+                "SELECT uid FROM jobs WHERE attempts < ? AND (status IN ('pending', 'failed') OR "
+                "(status = 'leased' AND lease_expires < ?)) ORDER BY attempts, uid LIMIT ?",
+                (JOB_MAX_ATTEMPTS, now, count))]
+            self.conn.executemany("UPDATE jobs SET status = 'leased', attempts = attempts + 1, owner = ?, lease_expires = ?, "
+                                  "updated = ? WHERE uid = ?",
+                                  ((self.owner, now + self.lease_seconds, now, uid) for uid in uids))
+        return uids
+
+    def renew(self):
+        """
+        DESCRIPTION:
+            extend the leases held by this process, so the uids waiting in its queue are not handed out again
+        """
+        now = time.time()
+        with self._transaction():
+            self.conn.execute("UPDATE jobs SET lease_expires = ? WHERE status = 'leased' AND owner = ?",
+                              (now + self.lease_seconds, self.owner))
+
+    def finish(self, job_results):
+        """
+        DESCRIPTION:
+            mark the uids of a list of JobResult done or failed in one transaction
+        """
+        now = time.time()
+        with self._transaction():
+            self.conn.executemany("UPDATE jobs SET status = ?, error = ?, owner = NULL, lease_expires = NULL, updated = ? "
+                                  "WHERE uid = ?",
+                                  (("failed" if error else "done", error, now, uid) for uid, error in job_results))
+
+    def release_dead_leases(self):
+        """
+        DESCRIPTION:
+            give the uids leased by the processes of this host that are not running anymore back as pending,
+            eg. the uids of the previous run of a restarted crawl, so they are not waited for until their leases expire.
+            The leases of other hosts can only expire
+
+        OUTPUT:
+            the amount of uids given back
+        """
+        host_prefix = self.owner.rsplit(":", 1)[0] + ":"
+        with self._lock:
+            owners = [owner for owner, in self.conn.execute(
+                "SELECT DISTINCT owner FROM jobs WHERE status = 'leased' AND substr(owner, 1, ?) = ?", (len(host_prefix), host_prefix))]
+        dead_owners = [owner for owner in owners if owner != self.owner and not _is_process_running(owner)]
+        if not dead_owners:
+            return 0
+        now = time.time()
+        with self._transaction():
+            released = self.conn.execute(
+                f"UPDATE jobs SET status = 'pending', owner = NULL, lease_expires = NULL, updated = ? "
+                f"WHERE status = 'leased' AND owner IN ({','.join('?' * len(dead_owners))})", (now, *dead_owners)).rowcount
+        return released
+
+    def count_leased_by_others(self):
+        """
+        OUTPUT:
+            the amount of uids leased by other processes whose lease has not expired
+        """
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'leased' AND lease_expires >= ? AND owner != ?",
+                                     (time.time(), self.owner)).fetchone()[0]
+
+    def status_counts(self):
+        with self._lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _transaction(self):
+        return _ImmediateTransaction(self.conn, self._lock)
+
+
+def _is_process_running(owner):
+    """
+    DESCRIPTION:
+        check if the process of an owner of this host, host:pid, is still running
+    """
+    try:
+        os.kill(int(owner.rsplit(":", 1)[1]), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, IndexError, PermissionError):
+        # not an owner this table made, or a process of another user
+        return True
+    return True
+
+
+class _ImmediateTransaction:
+    # takes the write lock at the start, so two processes cannot read the same uids before either has updated them.
+    # The thread lock keeps the other threads off the connection until the transaction ends
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.lock.release()
+
+
+async def job_uid_source(job_table, seed_source, claim_size=JOB_CLAIM_SIZE):
+    """
+    DESCRIPTION:
+        add the uids of seed_source to the job table, and yield the uids claimed from it batch by batch.
+        A batch is claimed after every chunk of the seed source is added, so the workers start before a long source is read through.
+        When nothing can be claimed but other processes still hold leases, it waits, as their leases may expire.
+        The leases of the dead processes of this host, eg. the previous run of a restarted crawl, are given back instead.
+        It yields None before it waits, so the consumer hands out the uids it holds: the other processes may be waiting
+        for those leases in turn. It ends when every uid is done, failed JOB_MAX_ATTEMPTS times or leased by this process.
+
+    INPUT:
+        job_table: JobTable
+        seed_source: async uid source, eg. get_uid_source(RANGE_FROM, RANGE_TO, LIMIT)
+        claim_size: the amount of uids claimed at a time
+
+    OUTPUT:
+        async generator of uids, and None before waiting
+    """
+    chunk = []
+    async for uid in seed_source:
+        chunk.append(uid)
+        if len(chunk) >= UID_CHUNK_SIZE:
+            await asyncio.to_thread(job_table.add_uids, chunk)
+            chunk = []
+            for uid in await asyncio.to_thread(job_table.claim, claim_size):
+                yield uid
+    await asyncio.to_thread(job_table.add_uids, chunk)
+
+    while True:
+        uids = await asyncio.to_thread(job_table.claim, claim_size)
+        if uids:
+            for uid in uids:
+                yield uid
+        elif await asyncio.to_thread(job_table.release_dead_leases):
+            continue
+        elif await asyncio.to_thread(job_table.count_leased_by_others):
+            yield None
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+        else:
+            break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="show the status of the job table")
+    parser.add_argument("--db", default=JOB_DB_FILE, help="the job table database")
+    args = parser.parse_args()
+    if not args.db:
+        parser.error("JOB_DB_FILE is not set, pass --db")
+    job_table = JobTable(args.db)
+    for status, count in sorted(job_table.status_counts().items()):
+        print(f"{status:<10}{count:>12}")
+    job_table.close()
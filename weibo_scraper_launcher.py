@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+
+import orjson
+from aiohttp import web
+
+import weibo_scraper_utils
+import weibo_scraper_with_proxy_pool as scraper
+from weibo_scraper_settings import RANGE_FROM, RANGE_TO, LIMIT, WORKER_SIZE, CSV_OUTPUT_FOLDER, LOG_OUTPUT_FOLDER, \
+    OUTPUT_SINK, PROXY_BROKER_BATCH, PROXY_BROKER_LEASE_TTL
+from weibo_scraper_sinks import merge_outputs
+from weibo_scraper_uid_sources import get_uid_source
+from weibo_scraper_utils import close_files
+
+
+def split_range(range_from, range_to, shard_count):
+    """
+    DESCRIPTION:
+        split the inclusive uid range into at most shard_count inclusive ranges of the same width
+    """
+    width = -(-(range_to - range_from + 1) // shard_count)
+    return [(shard_from, min(shard_from + width - 1, range_to)) for shard_from in range(range_from, range_to + 1, width)]
+
+
+async def proxies_handler(request):
+    """
+    DESCRIPTION:
+        lease up to count checked proxies to a shard, as a json list of [addr, latency].
+        The proxies stay leased by the broker, so every proxy is handed to one shard only,
+        and the shard keeps the health record from then on. The lease ends when the shard gives the proxy back
+        at /leases or stops renewing it for PROXY_BROKER_LEASE_TTL seconds.
+        A shard that already has its share of the proxies, have in the query, gets no more,
+        so the first shard to ask does not take them all. An evicted proxy makes room for a new one.
+    """
+    share = -(-len(scraper._PROXY_REGISTRY) // request.app["shard_count"])
+    count = min(int(request.query.get("count", PROXY_BROKER_BATCH)), share - int(request.query.get("have", 0)))
+    proxies = []
+    while len(proxies) < count:
+        addr = scraper._PROXY_REGISTRY.get_nowait()
+        if not addr:
+            break
+        proxies.append((addr, scraper._PROXY_REGISTRY.stats(addr).ewma_latency))
+        request.app["leases"][addr] = time.monotonic() + PROXY_BROKER_LEASE_TTL
+    return web.Response(body=orjson.dumps(proxies), content_type="application/json")
+
+
+async def leases_handler(request):
+    """
+    DESCRIPTION:
+        renew the leases of the proxies a shard still has, held in the json body, and end the leases of the ones
+        it gives back, released in the json body, eg. the ones the shard has evicted or all of them when it stops
+    """
+    body = orjson.loads(await request.read())
+    leases = request.app["leases"]
+    expires = time.monotonic() + PROXY_BROKER_LEASE_TTL
+    for addr in body.get("held", []):
+        if addr in leases:
+            leases[addr] = expires
+    for addr in body.get("released", []):
+        if leases.pop(addr, None) is not None:
+            recheck_proxy(addr)
+    return web.Response(status=204)
+
+
+def recheck_proxy(addr):
+    """
+    DESCRIPTION:
+        a proxy that has come back from a shard is checked again from scratch by proxy boss' checkers,
+        the shard kept its health record, so the one of the broker is out of date
+    """
+    scraper._PROXY_REGISTRY.remove(addr)
+    scraper._UNCHECKED_PROXY_QUEUE.put_nowait((addr, 0))
+
+
+async def lease_sweeper(leases):
+    """
+    Life Cycle:
+        lease sweeper is started by the proxy broker and ends the leases that have not been renewed in time,
+        he is cancelled when the broker gets off work.
+    """
+    while True:
+        await asyncio.sleep(PROXY_BROKER_LEASE_TTL / 3)
+        now = time.monotonic()
+        for addr in [addr for addr, expires in leases.items() if expires < now]:
+            del leases[addr]
+            recheck_proxy(addr)
+
+
+def serve_proxy_broker(ready_connection, shard_count):
+    """
+    DESCRIPTION:
+        the proxy broker process. It runs proxy boss, so the proxies are checked once for all the shards,
+        and hands the checked proxies out at /proxies, they are given back or renewed at /leases.
+        The url of the broker is sent to ready_connection.
+
+    Life Cycle:
+        The broker runs until it receives SIGTERM from the launcher.
+    """
+    async def serve():
+        app = web.Application()
+        app["shard_count"] = shard_count
+        app["leases"] = {}
+        app.router.add_get("/proxies", proxies_handler)
+        app.router.add_post("/leases", leases_handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        boss = asyncio.create_task(scraper.proxy_boss())
+        sweeper = asyncio.create_task(lease_sweeper(app["leases"]))
+        ready_connection.send(f"http://127.0.0.1:{port}")
+        try:
+            # if proxy boss fails, the broker gets off work and the launcher stops the shards
+            await asyncio.wait([boss, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+            if boss.done():
+                boss.result()
+        finally:
+            boss.cancel()
+            sweeper.cancel()
+            await asyncio.gather(boss, sweeper, return_exceptions=True)
+            await runner.cleanup()
+            await scraper.get_shared_connector().close()
+            await close_files()
+
+    asyncio.run(serve())
+
+
+def run_shard(shard_index, range_from, range_to, limit, worker_size, broker_url, output_location):
+    """
+    DESCRIPTION:
+        a shard process: scrape the uids between range_from and range_to with the proxies of the broker.
+        Every shard logs to its own folder in LOG_OUTPUT_FOLDER and serves its metrics on METRICS_PORT + shard_index.
+        The shards share STATE_DB_FILE, the uid ranges do not overlap.
+    """
+    log_folder = f"{LOG_OUTPUT_FOLDER}shard_{shard_index}/"
+    os.makedirs(log_folder, exist_ok=True)
+    weibo_scraper_utils.LOG_OUTPUT_FOLDER = scraper.LOG_OUTPUT_FOLDER = log_folder
+    scraper.PROXY_BROKER_URL = broker_url
+    scraper.WORKER_SIZE = worker_size
+    # an open write transaction would lock the shared state database for the other shards
+    scraper.STATE_COMMIT_INTERVAL = 1
+    if scraper.METRICS_PORT is not None:
+        scraper.METRICS_PORT += shard_index
+    uid_source = get_uid_source(range_from, range_to, limit)
+    asyncio.run(scraper.initiator(worker_size, uid_source, output_location))
+
+
+def launch(shard_count, worker_size, keep_shards=False):
+    """
+    DESCRIPTION:
+        split RANGE_FROM - RANGE_TO into shard_count shards and scrape them in one process each,
+        with one proxy broker process checking the proxies for all of them.
+        Every shard writes its own output, and the outputs are merged into weibo_final_{RANGE_FROM} at the end.
+        The shard outputs are deleted after the merge unless keep_shards is set or a shard failed.
+
+    OUTPUT:
+        0 if all the shards completed, otherwise 1
+    """
+    # spawn, so the shards do not inherit the event loop objects of this process
+    context = multiprocessing.get_context("spawn")
+    parent_connection, child_connection = context.Pipe()
+    ranges = split_range(RANGE_FROM, RANGE_TO, shard_count)
+    broker = context.Process(target=serve_proxy_broker, args=(child_connection, len(ranges)), name="proxy broker")
+    broker.start()
+    shard_limit = -(-LIMIT // len(ranges))
+    shards = []
+    try:
+        if not parent_connection.poll(30):
+            raise RuntimeError("the proxy broker did not start")
+        broker_url = parent_connection.recv()
+
+        for shard_index, (shard_from, shard_to) in enumerate(ranges):
+            output_location = f"{CSV_OUTPUT_FOLDER}weibo_shard_{shard_from}"
+            process = context.Process(target=run_shard, name=f"shard {shard_index} ({shard_from}-{shard_to})",
+                                      args=(shard_index, shard_from, shard_to, shard_limit, worker_size, broker_url, output_location))
+            process.start()
+            shards.append((process, output_location))
+
+        pending = {process.sentinel: process for process, _ in shards}
+        while pending:
+            for sentinel in multiprocessing.connection.wait(list(pending) + [broker.sentinel]):
+                # the shards cannot get proxies without the broker
+                if sentinel == broker.sentinel:
+                    raise RuntimeError(f"the proxy broker exited with {broker.exitcode}")
+                process = pending.pop(sentinel)
+                process.join()
+                print(f"{process.name} exited with {process.exitcode}")
+    finally:
+        for process, _ in shards:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        broker.terminate()
+        broker.join()
+
+    merged_location = f"{CSV_OUTPUT_FOLDER}weibo_final_{RANGE_FROM}"
+    merged_paths = asyncio.run(merge_outputs(OUTPUT_SINK, [output_location for _, output_location in shards], merged_location))
+    print(f"merged {len(merged_paths)} shard outputs into {merged_location}")
+    failed = [process.name for process, _ in shards if process.exitcode != 0]
+    if failed:
+        print(f"failed: {', '.join(failed)}, the shard outputs are kept")
+        return 1
+    if not keep_shards:
+        for path in merged_paths:
+            os.remove(path)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="scrape RANGE_FROM - RANGE_TO in several processes sharing one proxy broker")
+    parser.add_argument("--shards", type=int, default=os.cpu_count(), help="the amount of scraper processes")
+    parser.add_argument("--workers", type=int, default=WORKER_SIZE, help="mweibo workers per shard")
+    parser.add_argument("--keep-shards", action="store_true", help="keep the shard outputs after the merge")
+    args = parser.parse_args()
+    sys.exit(launch(args.shards, args.workers, args.keep_shards))
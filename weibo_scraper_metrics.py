@@ -0,0 +1,250 @@
+import asyncio
+import bisect
+import time
+
+import aiofiles
+import orjson
+from aiohttp import web
+
+
+_DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds
+
+
+def _label_string(label_names, label_values):
+    if not label_names:
+        return ""
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{name}=\"{value}\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """
+    DESCRIPTION:
+        a value that only goes up, one per combination of label values
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_label_string(self.label_names, label_values)} {value}"
+
+    def snapshot(self):
+        return {",".join(map(str, label_values)): value for label_values, value in self.values.items()}
+
+
+class Gauge(Counter):
+    """
+    DESCRIPTION:
+        a value that goes up and down. It is either set, or read from a function when it is rendered,
+        eg. the size of a queue
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self.functions = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def set_function(self, function, *label_values):
+        self.functions[label_values] = function
+
+    def _read_functions(self):
+        for label_values, function in self.functions.items():
+            self.values[label_values] = function()
+
+    def render(self):
+        self._read_functions()
+        return super().render()
+
+    def snapshot(self):
+        self._read_functions()
+        return super().snapshot()
+
+
+class Histogram:
+    """
+    DESCRIPTION:
+        counts of observed values in buckets, one set of buckets per combination of label values
+
+    DATA STRUCTURE:
+        values, # dict of label values: [count per bucket, the last one is +Inf], sum, count
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=_DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        record = self.values.get(label_values)
+        if record is None:
+            record = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+        record[0][bisect.bisect_left(self.buckets, value)] += 1
+        record[1] += value
+        record[2] += 1
+
+    def render(self):
+        for label_values, (bucket_counts, value_sum, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                labels = _label_string(self.label_names + ("le",), label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _label_string(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {value_sum}"
+            yield f"{self.name}_count{labels} {count}"
+
+    def snapshot(self):
+        return {",".join(map(str, label_values)): {"count": count, "sum": value_sum,
+                                                   "buckets": dict(zip(map(str, self.buckets + ("+Inf",)), bucket_counts))}
+                for label_values, (bucket_counts, value_sum, count) in self.values.items()}
+
+
+class MetricsRegistry:
+    """
+    Description:
+        This is the set of metrics of the scraper. The metrics are plain python objects updated in the event loop,
+        so recording one costs a dict lookup. They are rendered in the prometheus text format by the metrics server
+        and dumped as json snapshots by the metrics reporter.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=_DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+METRICS = MetricsRegistry()
+
+FETCH_SECONDS = METRICS.histogram("weibo_fetch_seconds", "response time of the requests through proxies", ("endpoint",))
+PROXY_REQUESTS = METRICS.counter("weibo_proxy_requests_total",
+                                 "requests per proxy and result, the result is ok, http_<status> or the error class",
+                                 ("proxy", "result"))
+HEDGES = METRICS.counter("weibo_hedges_total", "requests sent again through a second proxy, the result is won or lost",
+                         ("endpoint", "result"))
+ERRORS = METRICS.counter("weibo_errors_total", "errors while handling the responses, eg. errmsg or a broken json",
+                         ("stage", "error"))
+USERS = METRICS.counter("weibo_users_total", "users whose timeline has been walked")
+ROWS = METRICS.counter("weibo_rows_total", "rows written by the writer")
+SEEN_SKIPPED = METRICS.counter("weibo_seen_skipped_total", "weibos skipped because their id has been written before")
+ROWS_PER_SECOND = METRICS.gauge("weibo_rows_per_second", "rows written per second over the last metrics interval")
+WRITE_SECONDS = METRICS.histogram("weibo_write_seconds", "time the writer takes to write one page of rows",
+                                  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+TRACES = METRICS.counter("weibo_traces_total", "user traces written, the reason is sampled or slow", ("reason",))
+LOOP_LAG = METRICS.histogram("weibo_loop_lag_seconds", "how much later than asked the event loop wakes up a sleeping coroutine",
+                              buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+OFFLOADED = METRICS.counter("weibo_offloaded_total", "pages parsed in the offload process pool instead of on the event loop",
+                            ("function",))
+QUEUE_DEPTH = METRICS.gauge("weibo_queue_depth", "items waiting in the queues of the pipeline", ("queue",))
+
+
+async def metrics_handler(request):
+    return web.Response(text=METRICS.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def metrics_json_handler(request):
+    return web.Response(body=orjson.dumps(METRICS.snapshot()), content_type="application/json")
+
+
+async def start_metrics_server(host, port):
+    """
+    DESCRIPTION:
+        serve the metrics at http://host:port/metrics in the prometheus text format and at /metrics.json
+
+    OUTPUT:
+        the aiohttp AppRunner, clean it up to stop the server
+
+    Error handling:
+        OSError if the port cannot be bound, eg. another crawl serves its metrics there
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/metrics.json", metrics_json_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    return runner
+
+
+async def metrics_reporter(interval, snapshot_file=None):
+    """
+    DESCRIPTION:
+        every interval seconds, update the rows per second and, if snapshot_file is given,
+        append a json snapshot of all the metrics to it as one line
+
+    Life Cycle:
+        metrics reporter is started by the main boss and cancelled when the work is done.
+        He reports one last time when he is cancelled.
+    """
+    last_rows = ROWS.total()
+    last_time = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            last_rows, last_time = await report_metrics(snapshot_file, last_rows, last_time)
+    finally:
+        await report_metrics(snapshot_file, last_rows, last_time)
+
+
+async def report_metrics(snapshot_file, last_rows, last_time):
+    """
+    OUTPUT:
+        the rows written and the time of this report, to be passed as last_rows and last_time to the next one
+    """
+    rows = ROWS.total()
+    now = time.monotonic()
+    if now > last_time:
+        ROWS_PER_SECOND.set((rows - last_rows) / (now - last_time))
+    if snapshot_file:
+        snapshot = METRICS.snapshot()
+        snapshot["time"] = time.time()
+        async with aiofiles.open(snapshot_file, 'ab') as file:
+            await file.write(orjson.dumps(snapshot) + b"\n")
+    return rows, now
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+import orjson
+from aiohttp import web
+
+
+PAGE_SIZE = 10
+# the amount of cards in a timeline page
+
+_ID_BASE = 10 ** 6
+_FIRST_POST_TIME = 1703660118
+
+
+class MockConfig:
+    """
+    DESCRIPTION:
+        behaviour of the mock m.weibo.cn and the mock proxies
+
+    DATA STRUCTURE:
+        proxy_count, # the amount of mock proxies
+        proxy_latency, # mean seconds a proxy adds to every request
+        proxy_failure_rate, # chance that a proxy drops the connection
+        proxy_throttle_rate, # chance that a proxy answers with weibo's 418 throttle response
+        bad_proxy_ratio, # share of proxies that are 10 times slower and fail 5 times more often
+        server_latency, # seconds the mock m.weibo.cn takes per request
+        posts_scale, # the post count of a user is pareto distributed, posts_scale is its minimum
+        max_posts, # the post count of a user is at most this
+        long_text_ratio, # share of the weibos truncated with 全文
+        seed
+    """
+
+    def __init__(self, proxy_count=20, proxy_latency=0.05, proxy_failure_rate=0.02, proxy_throttle_rate=0.01,
+                 bad_proxy_ratio=0.2, server_latency=0.005, posts_scale=10, max_posts=2000, long_text_ratio=0.2, seed=0):
+        self.proxy_count = proxy_count
+        self.proxy_latency = proxy_latency
+        self.proxy_failure_rate = proxy_failure_rate
+        self.proxy_throttle_rate = proxy_throttle_rate
+        self.bad_proxy_ratio = bad_proxy_ratio
+        self.server_latency = server_latency
+        self.posts_scale = posts_scale
+        self.max_posts = max_posts
+        self.long_text_ratio = long_text_ratio
+        self.seed = seed
+
+
+def get_post_count(config, uid):
+    """
+    DESCRIPTION:
+        the post count of a mock user, heavy tailed like the real ones and stable for the same uid and seed
+    """
+    rng = random.Random(uid * 1000003 + config.seed)
+    return min(config.max_posts, int(config.posts_scale * rng.paretovariate(1.2)))
+
+
+def get_mock_mblog(config, uid, index, post_count, full_text=False):
+    """
+    DESCRIPTION:
+        the index-th newest weibo of a mock user, index 0 is the newest
+    """
+    rng = random.Random(uid * 7919 + index + config.seed)
+    url_id = uid * _ID_BASE + (post_count - index)
+    created_at = time.strftime("%a %b %d %H:%M:%S +0800 %Y", time.gmtime(_FIRST_POST_TIME - index * 3600 + 8 * 3600))
+    text = f"mock weibo {index} of {uid} &amp; some <span class=\"surl-text\">#topic#</span> text"
+    if rng.random() < config.long_text_ratio:
+        if full_text:
+            text = text + " the rest of the long text" * 20
+        else:
+            text = text + f"...<a href=\"/status/{url_id}\">全文</a>"
+    pic_ids = [f"{rng.getrandbits(64):016x}" for _ in range(rng.choice([0, 0, 1, 3]))]
+    return {
+        "id": str(url_id),
+        "created_at": created_at,
+        "text": text,
+        "user": {"id": uid, "statuses_count": post_count},
+        "reposts_count": rng.randint(0, 100),
+        "comments_count": rng.randint(0, 100),
+        "attitudes_count": rng.randint(0, 1000),
+        "pic_num": len(pic_ids),
+        "pic_ids": pic_ids,
+    }
+
+
+async def weibo_index_page(request):
+    config = request.app["config"]
+    await _serve(request, "index page")
+    response = web.Response(text=f"<html><body>mock user {request.match_info['uid']}</body></html>", content_type="text/html")
+    response.set_cookie("_T_WM", str(config.seed))
+    return response
+
+
+async def weibo_get_index(request):
+    config = request.app["config"]
+    uid = int(request.query["value"])
+    post_count = get_post_count(config, uid)
+    containerid = request.query.get("containerid")
+    if not containerid:
+        await _serve(request, "getIndex")
+        return web.json_response({"ok": 1, "data": {
+            "userInfo": {"id": uid, "statuses_count": post_count},
+            "tabsInfo": {"selectedTab": 1, "tabs": [{"tab_type": "profile", "containerid": f"230283{uid}"},
+                                                     {"tab_type": "weibo", "containerid": f"107603{uid}"}]},
+        }}, dumps=_dumps)
+
+    await _serve(request, "timeline page")
+    since_id = request.query.get("since_id")
+    page = request.query.get("page")
+    if since_id:
+        start = post_count - (int(since_id) - uid * _ID_BASE)
+    elif page:
+        start = (int(page) - 1) * PAGE_SIZE
+    else:
+        start = 0
+    end = min(start + PAGE_SIZE, post_count)
+    cards = [{"card_type": 9, "mblog": get_mock_mblog(config, uid, index, post_count)} for index in range(start, end)]
+    cardlist_info = {"containerid": containerid, "total": post_count}
+    if end < post_count:
+        cardlist_info["since_id"] = uid * _ID_BASE + (post_count - end)
+    return web.json_response({"ok": 1, "data": {"cardlistInfo": cardlist_info, "cards": cards}}, dumps=_dumps)
+
+
+async def weibo_detail_page(request):
+    config = request.app["config"]
+    await _serve(request, "detail page")
+    url_id = int(request.match_info["url_id"])
+    uid = url_id // _ID_BASE
+    post_count = get_post_count(config, uid)
+    status = get_mock_mblog(config, uid, post_count - url_id % _ID_BASE, post_count, full_text=True)
+    render_data = orjson.dumps({"status": status}).decode()
+    return web.Response(text=f"<html><script>var $render_data = [{render_data}][0] || {{}};</script></html>",
+                        content_type="text/html")
+
+
+async def weibo_root(request):
+    config = request.app["config"]
+    await _serve(request, "root")
+    response = web.Response(text="<html>mock m.weibo.cn</html>", content_type="text/html")
+    response.set_cookie("_T_WM", str(config.seed))
+    return response
+
+
+async def proxy_list(request):
+    """
+    DESCRIPTION:
+        stand-in for the proxy pool api at PROXY_POOL_URL
+    """
+    last_time = time.strftime("%Y-%m-%d %H:%M:%S")
+    return web.json_response([{"proxy": addr, "last_time": last_time} for addr in request.app["proxy_addrs"]], dumps=_dumps)
+
+
+async def stats(request):
+    return web.json_response(request.app["counters"], dumps=_dumps)
+
+
+async def _serve(request, endpoint):
+    counters = request.app["counters"]
+    counters[endpoint] = counters.get(endpoint, 0) + 1
+    if request.app["config"].server_latency:
+        await asyncio.sleep(request.app["config"].server_latency)
+
+
+def _dumps(data):
+    return orjson.dumps(data).decode()
+
+
+def make_weibo_app(config, proxy_addrs):
+    app = web.Application()
+    app["config"] = config
+    app["proxy_addrs"] = proxy_addrs
+    app["counters"] = {}
+    app.router.add_get("/", weibo_root)
+    app.router.add_get("/u/{uid}", weibo_index_page)
+    app.router.add_get("/api/container/getIndex", weibo_get_index)
+    app.router.add_get("/status/{url_id}", weibo_detail_page)
+    app.router.add_get("/all/", proxy_list)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+async def proxy_forward(request):
+    """
+    DESCRIPTION:
+        a plain http forward proxy with latency, dropped connections and throttling.
+        aiohttp sends proxied http requests in absolute form, so request.url is the target url.
+    """
+    behaviour = request.app["behaviour"]
+    rng = request.app["random"]
+    await asyncio.sleep(max(0, rng.gauss(behaviour["latency"], behaviour["latency"] * 0.3)))
+    chance = rng.random()
+    if chance < behaviour["failure_rate"]:
+        request.transport.close()
+        return web.Response(status=502)
+    if chance < behaviour["failure_rate"] + behaviour["throttle_rate"]:
+        return web.json_response({"ok": 0, "errno": "100005", "msg": "请求过于频繁"}, status=418, dumps=_dumps)
+
+    headers = {key: value for key, value in request.headers.items() if key.lower() in ("cookie", "accept", "referer")}
+    async with request.app["session"].request(request.method, request.url, headers=headers, allow_redirects=False) as resp:
+        body = await resp.read()
+        response = web.Response(body=body, status=resp.status, content_type=resp.content_type)
+        for cookie in resp.headers.getall("Set-Cookie", []):
+            response.headers.add("Set-Cookie", cookie)
+        return response
+
+
+def make_proxy_app(behaviour, session, seed):
+    app = web.Application()
+    app["behaviour"] = behaviour
+    app["session"] = session
+    app["random"] = random.Random(seed)
+    app.router.add_route("*", "/{tail:.*}", proxy_forward)
+    return app
+
+
+async def start_mock_servers(config, host="127.0.0.1"):
+    """
+    DESCRIPTION:
+        start the mock m.weibo.cn, which also serves the proxy list and /stats, and config.proxy_count mock proxies
+
+    OUTPUT:
+        list of aiohttp AppRunner to clean up, base url of the mock m.weibo.cn, proxy list url, stats url
+    """
+    rng = random.Random(config.seed)
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+    runners = []
+    proxy_addrs = []
+    for index in range(config.proxy_count):
+        is_bad = rng.random() < config.bad_proxy_ratio
+        behaviour = {
+            "latency": config.proxy_latency * (10 if is_bad else 1),
+            "failure_rate": min(1, config.proxy_failure_rate * (5 if is_bad else 1)),
+            "throttle_rate": config.proxy_throttle_rate,
+        }
+        runner, port = await _start_app(make_proxy_app(behaviour, session, config.seed + index), host)
+        runners.append(runner)
+        proxy_addrs.append(f"{host}:{port}")
+
+    weibo_app = make_weibo_app(config, proxy_addrs)
+    weibo_app.on_cleanup.append(lambda app: session.close())
+    runner, port = await _start_app(weibo_app, host)
+    runners.append(runner)
+    base_url = f"http://{host}:{port}"
+    return runners, base_url, f"{base_url}/all/?type=https", f"{base_url}/stats"
+
+
+async def _start_app(app, host):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+
+def serve_mock_servers(config, ready_connection=None):
+    """
+    DESCRIPTION:
+        run the mock servers until the process is killed.
+        If ready_connection, a multiprocessing connection, is given, (base url, proxy list url, stats url) is sent to it.
+    """
+    async def serve():
+        runners, base_url, proxy_list_url, stats_url = await start_mock_servers(config)
+        if ready_connection is not None:
+            ready_connection.send((base_url, proxy_list_url, stats_url))
+        else:
+            print(f"mock m.weibo.cn: {base_url}\nproxy list: {proxy_list_url}\nstats: {stats_url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            # the mock m.weibo.cn is the last runner and closes the proxies' session
+            for runner in runners:
+                await runner.cleanup()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="mock m.weibo.cn and mock proxies for offline benchmarks")
+    parser.add_argument("--proxies", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    serve_mock_servers(MockConfig(proxy_count=args.proxies, seed=args.seed))
@@ -0,0 +1,146 @@
+import asyncio
+import concurrent.futures
+
+from weibo_scraper_metrics import LOOP_LAG, OFFLOADED
+
+
+def _run_batch(function, arguments):
+    """
+    DESCRIPTION:
+        run function on every argument of a batch in a pool process
+
+    OUTPUT:
+        list of (True, result) or (False, exception raised), in the order of the arguments
+    """
+    results = []
+    for argument in arguments:
+        try:
+            results.append((True, function(argument)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class LoopLagMonitor:
+    """
+    Description:
+        This samples the event loop lag: how much later than asked a sleeping coroutine wakes up,
+        namely how long the callbacks of the finished requests wait behind the code running on the loop.
+        Every sample is observed in LOOP_LAG, and the moving average of the samples tells the offloader
+        whether the loop is overloaded.
+
+    DATA STRUCTURE:
+        lag, # moving average of the lag in seconds
+        max_lag # the largest lag sampled
+    """
+
+    def __init__(self, interval, alpha=0.3):
+        self.interval = interval
+        self.alpha = alpha
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    async def run(self):
+        """
+        Life Cycle:
+            lag monitor is started by the scraper engine and cancelled when it stops.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            start_time = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start_time - self.interval)
+            LOOP_LAG.observe(lag)
+            self.lag += self.alpha * (lag - self.lag)
+            self.max_lag = max(self.max_lag, lag)
+
+
+class ParseOffloader:
+    """
+    Description:
+        This runs the CPU heavy parsing functions in a pool of processes while the event loop lags, and on the loop otherwise.
+        Offloading starts when the average lag of the monitor rises above lag_threshold, and stops when it falls
+        below half of it, so it does not flip on every page. The process pool is created the first time it is needed.
+        The calls of a function are sent to the pool in batches of batch_size, or after waiting batch_delay seconds
+        for a full batch, so a round trip to a process carries several pages.
+        The functions and their arguments must be picklable, eg. module level functions of page text.
+    """
+
+    def __init__(self, monitor, processes, lag_threshold, batch_size, batch_delay):
+        self.monitor = monitor
+        self.processes = processes
+        self.lag_threshold = lag_threshold
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.active = False
+        self._executor = None
+        self._pending = {}
+        self._timers = {}
+
+    async def run(self, function, argument):
+        """
+        OUTPUT:
+            function(argument), the exception it raises is raised here
+        """
+        if self.active and self.monitor.lag < self.lag_threshold / 2:
+            self.active = False
+        elif not self.active and self.monitor.lag >= self.lag_threshold:
+            self.active = True
+        if not self.active:
+            return function(argument)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(function, [])
+        pending.append((argument, future))
+        if len(pending) >= self.batch_size:
+            self._flush(function)
+        elif len(pending) == 1:
+            self._timers[function] = loop.call_later(self.batch_delay, self._flush, function)
+        return await future
+
+    def _flush(self, function):
+        timer = self._timers.pop(function, None)
+        if timer:
+            timer.cancel()
+        pending = self._pending.pop(function, None)
+        if not pending:
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        OFFLOADED.inc(function.__name__, amount=len(pending))
+        batch = asyncio.wrap_future(self._executor.submit(_run_batch, function, [argument for argument, _ in pending]))
+        batch.add_done_callback(lambda batch: self._resolve(pending, batch))
+
+    def _resolve(self, pending, batch):
+        if batch.cancelled():
+            for _, future in pending:
+                future.cancel()
+            return
+        exception = batch.exception()
+        if isinstance(exception, concurrent.futures.process.BrokenProcessPool):
+            # a process died, eg. killed for memory. The next batch starts a new pool
+            self._executor = None
+        for index, (_, future) in enumerate(pending):
+            # the caller may have been cancelled while the batch was in the pool
+            if future.done():
+                continue
+            if exception:
+                future.set_exception(exception)
+                continue
+            succeeded, result = batch.result()[index]
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def close(self):
+        for function in list(self._pending):
+            timer = self._timers.pop(function, None)
+            if timer:
+                timer.cancel()
+            for _, future in self._pending.pop(function):
+                future.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,277 @@
+import asyncio
+import time
+
+from weibo_scraper_settings import PROXY_EWMA_ALPHA, PROXY_BREAKER_THRESHOLD, PROXY_COOLDOWN, \
+    PROXY_EVICT_MIN_ATTEMPTS, PROXY_EVICT_SUCCESS_RATE, PROXY_TIMEOUT
+
+
+class ProxyStats:
+    """
+    DESCRIPTION:
+        health record of one proxy address
+
+    DATA STRUCTURE:
+        addr, # proxy address, eg. http://1.2.3.4:8080
+        ewma_latency, # exponentially weighted moving average of response time in seconds
+        successes,
+        failures,
+        consecutive_failures, # failures since the last success, drives the circuit breaker
+        last_failure, # time.time() of the latest failure, 0 if never failed
+        cooldown_until, # time.monotonic() until which the circuit is open and the proxy is not handed out
+        last_seen # time.monotonic() of the latest check or successful request
+    """
+    __slots__ = ("addr", "ewma_latency", "successes", "failures", "consecutive_failures", "last_failure", "cooldown_until",
+                 "last_seen")
+
+    def __init__(self, addr, latency=None):
+        self.addr = addr
+        self.ewma_latency = latency if latency is not None else PROXY_TIMEOUT
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_failure = 0
+        self.cooldown_until = 0
+        self.last_seen = time.monotonic()
+
+    @property
+    def success_rate(self):
+        # laplace smoothing, so that a fresh proxy scores 0.5 instead of 0 or 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self):
+        # expected seconds per successful request, lower is better
+        return self.ewma_latency / self.success_rate
+
+
+class ProxyRegistry:
+    """
+    Description:
+        This is the pool of checked proxies that replaces the plain FIFO queue.
+        It keeps a ProxyStats for every proxy and hands out the proxy with the best score first.
+        A proxy that is handed out is leased by the caller until it is released, so that a worker
+        can keep a consistent proxy.
+
+    Circuit breaker:
+        A proxy that fails PROXY_BREAKER_THRESHOLD times in a row is benched for PROXY_COOLDOWN seconds.
+        After the cooldown it is handed out again (half-open), and one more failure benches it again.
+        A proxy whose success rate stays under PROXY_EVICT_SUCCESS_RATE is dropped from the registry,
+        so that proxy boss can check it again from scratch.
+        on_remove is called with the address of every proxy dropped from the registry, to drop what else is kept per proxy.
+    """
+
+    def __init__(self, on_remove=None):
+        self.on_remove = on_remove
+        self._stats = {}
+        self._idle = set()
+        self._leased = set()
+        self._cooling = set()
+        self._available = asyncio.Event()
+
+    def __contains__(self, addr):
+        return addr in self._stats
+
+    def __len__(self):
+        return len(self._stats)
+
+    def qsize(self):
+        """
+        DESCRIPTION:
+            the number of proxies that can be handed out right now, like asyncio.Queue.qsize()
+        """
+        self._promote_cooled()
+        return len(self._idle)
+
+    def stats(self, addr):
+        return self._stats.get(addr)
+
+    def put(self, addr, latency=None):
+        """
+        DESCRIPTION:
+            add a proxy that passed a check to the idle proxies.
+            The check latency is used as the first latency sample.
+        """
+        stats = self._stats.get(addr)
+        if stats is None:
+            self._stats[addr] = ProxyStats(addr, latency)
+        elif latency is not None:
+            self._update_latency(stats, latency)
+            stats.last_seen = time.monotonic()
+        if addr not in self._leased:
+            self._cooling.discard(addr)
+            self._idle.add(addr)
+            self._available.set()
+
+    async def get(self):
+        """
+        DESCRIPTION:
+            lease the idle proxy with the lowest score.
+            If there is none, wait until a proxy is put, released or comes back from cooldown.
+        """
+        while True:
+            addr = self._pick()
+            if addr:
+                return addr
+            self._available.clear()
+            try:
+                await asyncio.wait_for(self._available.wait(), self._next_cooldown_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    def get_nowait(self):
+        """
+        DESCRIPTION:
+            lease the best idle proxy, or return None if there is none
+        """
+        return self._pick()
+
+    def report_success(self, addr, latency):
+        stats = self._stats.get(addr)
+        if stats is None:
+            return
+        stats.successes += 1
+        stats.consecutive_failures = 0
+        stats.last_seen = time.monotonic()
+        self._update_latency(stats, latency)
+
+    def report_failure(self, addr):
+        stats = self._stats.get(addr)
+        if stats is None:
+            return
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        stats.last_failure = time.time()
+        # a failed request counts as a timeout for the latency average
+        self._update_latency(stats, PROXY_TIMEOUT)
+
+    def report_slow(self, addr, latency):
+        """
+        DESCRIPTION:
+            record that a request through the proxy was outrun by a hedge after latency seconds,
+            it is neither a success nor a failure, but the proxy is at least this slow
+        """
+        stats = self._stats.get(addr)
+        if stats is not None:
+            self._update_latency(stats, latency)
+
+    def release(self, addr):
+        """
+        DESCRIPTION:
+            give a leased proxy back to the registry.
+            Depending on its record it becomes idle, cools down or is evicted.
+
+        OUTPUT:
+            False if the proxy has been evicted, otherwise True
+        """
+        self._leased.discard(addr)
+        return self._settle(addr)
+
+    def report_check(self, addr, latency):
+        """
+        DESCRIPTION:
+            record the result of a re-validation, latency is None if the check failed.
+            An idle proxy that fails it cools down or is evicted like a released one.
+        """
+        if latency is not None:
+            self.report_success(addr, latency)
+            return
+        self.report_failure(addr)
+        if addr in self._idle:
+            self._idle.discard(addr)
+            self._settle(addr)
+
+    def stale_idle_proxies(self, age):
+        """
+        OUTPUT:
+            the idle proxies that have not been checked or used successfully for age seconds
+        """
+        seen_before = time.monotonic() - age
+        return [addr for addr in self._idle if self._stats[addr].last_seen < seen_before]
+
+    def dump(self):
+        """
+        DESCRIPTION:
+            the health records of all the known proxies as json-ready dicts, see load
+        """
+        return [{"addr": stats.addr, "ewma_latency": stats.ewma_latency, "successes": stats.successes,
+                 "failures": stats.failures, "consecutive_failures": stats.consecutive_failures,
+                 "last_failure": stats.last_failure}
+                for stats in self._stats.values()]
+
+    def load(self, records):
+        """
+        DESCRIPTION:
+            add the proxies of dump() from a previous run as idle proxies with their health records.
+            They can be handed out right away, and they count as not seen, so they are re-validated first.
+
+        OUTPUT:
+            the addresses that have been added
+        """
+        loaded = []
+        for record in records:
+            addr = record["addr"]
+            if addr in self._stats:
+                continue
+            stats = self._stats[addr] = ProxyStats(addr, record["ewma_latency"])
+            stats.successes = record["successes"]
+            stats.failures = record["failures"]
+            stats.consecutive_failures = record["consecutive_failures"]
+            stats.last_failure = record["last_failure"]
+            stats.last_seen = float("-inf")
+            self._idle.add(addr)
+            loaded.append(addr)
+        if loaded:
+            self._available.set()
+        return loaded
+
+    def remove(self, addr):
+        stats = self._stats.pop(addr, None)
+        self._idle.discard(addr)
+        self._leased.discard(addr)
+        self._cooling.discard(addr)
+        if stats is not None and self.on_remove:
+            self.on_remove(addr)
+
+    def _settle(self, addr):
+        # decide whether a proxy that is not leased becomes idle, cools down or is evicted
+        stats = self._stats.get(addr)
+        if stats is None:
+            return False
+        attempts = stats.successes + stats.failures
+        if attempts >= PROXY_EVICT_MIN_ATTEMPTS and stats.success_rate < PROXY_EVICT_SUCCESS_RATE:
+            self.remove(addr)
+            return False
+        if stats.consecutive_failures >= PROXY_BREAKER_THRESHOLD:
+            stats.cooldown_until = time.monotonic() + PROXY_COOLDOWN
+            self._cooling.add(addr)
+        else:
+            self._idle.add(addr)
+            self._available.set()
+        return True
+
+    def _update_latency(self, stats, latency):
+        stats.ewma_latency += PROXY_EWMA_ALPHA * (latency - stats.ewma_latency)
+
+    def _promote_cooled(self):
+        if not self._cooling:
+            return
+        now = time.monotonic()
+        cooled = [addr for addr in self._cooling if self._stats[addr].cooldown_until <= now]
+        for addr in cooled:
+            self._cooling.discard(addr)
+            self._idle.add(addr)
+
+    def _next_cooldown_delay(self):
+        if not self._cooling:
+            return None
+        now = time.monotonic()
+        return max(0, min(self._stats[addr].cooldown_until for addr in self._cooling) - now)
+
+    def _pick(self):
+        self._promote_cooled()
+        if not self._idle:
+            return None
+        addr = min(self._idle, key=lambda addr: self._stats[addr].score)
+        self._idle.discard(addr)
+        self._leased.add(addr)
+        return addr
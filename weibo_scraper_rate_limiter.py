@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from weibo_scraper_settings import RATE_LIMIT_INITIAL, RATE_LIMIT_MIN, RATE_LIMIT_MAX, RATE_LIMIT_INCREASE, \
+    RATE_LIMIT_DECREASE, RATE_LIMIT_BURST
+
+
+class TokenBucket:
+    """
+    DESCRIPTION:
+        request budget of one proxy
+
+    DATA STRUCTURE:
+        rate, # requests per second allowed right now
+        tokens, # requests that can be sent without waiting, at most RATE_LIMIT_BURST
+        updated, # time.monotonic() when tokens was last refilled
+        throttles # the amount of throttle signals of the proxy
+    """
+    __slots__ = ("rate", "tokens", "updated", "throttles")
+
+    def __init__(self):
+        self.rate = RATE_LIMIT_INITIAL
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.throttles = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(RATE_LIMIT_BURST, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class AdaptiveRateLimiter:
+    """
+    Description:
+        This is a token bucket rate limiter keyed by proxy that adapts its rate with AIMD.
+        Every clean response adds RATE_LIMIT_INCREASE requests per second to the proxy's rate, up to RATE_LIMIT_MAX,
+        and every throttle signal (errmsg, non-200 response, empty cards) multiplies it by RATE_LIMIT_DECREASE,
+        down to RATE_LIMIT_MIN, and empties the bucket so the next request through the proxy waits.
+        So healthy proxies run at full speed and throttled ones back off.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+
+    def _bucket(self, proxy_addr):
+        bucket = self._buckets.get(proxy_addr)
+        if bucket is None:
+            bucket = self._buckets[proxy_addr] = TokenBucket()
+        return bucket
+
+    async def acquire(self, proxy_addr):
+        """
+        DESCRIPTION:
+            wait until a request can be sent through the proxy
+        """
+        bucket = self._bucket(proxy_addr)
+        while True:
+            bucket.refill()
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+            await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def report_clean(self, proxy_addr):
+        bucket = self._bucket(proxy_addr)
+        bucket.rate = min(RATE_LIMIT_MAX, bucket.rate + RATE_LIMIT_INCREASE)
+
+    def report_throttled(self, proxy_addr):
+        bucket = self._bucket(proxy_addr)
+        bucket.refill()
+        bucket.rate = max(RATE_LIMIT_MIN, bucket.rate * RATE_LIMIT_DECREASE)
+        bucket.tokens = min(bucket.tokens, 0)
+        bucket.throttles += 1
+
+    def rate(self, proxy_addr):
+        return self._bucket(proxy_addr).rate
+
+    def throttle_count(self, proxy_addr):
+        return self._bucket(proxy_addr).throttles
+
+    def forget(self, proxy_addr):
+        # called when the proxy is dropped from the registry, so the buckets do not pile up over a long crawl.
+        # A proxy that comes back after a new check starts at RATE_LIMIT_INITIAL again
+        self._buckets.pop(proxy_addr, None)
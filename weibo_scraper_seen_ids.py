@@ -0,0 +1,97 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+
+_HEADER = struct.Struct("<8sQQQ")
+_MAGIC = b"WBLOOM02"
+_COUNT = struct.Struct("<Q")
+_COUNT_OFFSET = _HEADER.size - _COUNT.size
+
+
+class BloomFilter:
+    """
+    Description:
+        This is a compact set of the weibo ids that have been scraped. It never forgets an id that was added,
+        but it may answer that an id was added when it was not, with a probability of about error_rate
+        as long as it holds at most capacity ids. Its size is fixed by capacity and error_rate, eg. about
+        2.4 bytes per id for an error rate of 1e-4, no matter how many ids are added.
+        Past capacity the error rate climbs fast, eg. most ids look added at ten times capacity,
+        so the filter counts the ids added and is full once the count reaches capacity. The caller stops using it then.
+        If filename is given, the bits and the count are kept in that file with mmap, so the ids are remembered across runs
+        and the operating system decides how much of the filter stays in memory.
+
+    DATA STRUCTURE:
+        capacity,
+        bit_count, # the size of the filter in bits
+        hash_count, # the amount of bits set per id
+        count, # the amount of ids added, an id that was already in the filter is not counted again
+        bits # bytearray, or mmap of the file with the header
+    """
+
+    def __init__(self, capacity, error_rate, filename=None):
+        self.capacity = capacity
+        self.count = 0
+        self.bit_count = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.file = None
+        self._offset = 0
+        byte_count = (self.bit_count + 7) // 8
+        if not filename:
+            self.bits = bytearray(byte_count)
+            return
+
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as file:
+                file.write(_HEADER.pack(_MAGIC, self.bit_count, self.hash_count, 0))
+                file.truncate(_HEADER.size + byte_count)
+        self.file = open(filename, 'r+b')
+        magic, bit_count, hash_count, self.count = _HEADER.unpack(self.file.read(_HEADER.size))
+        if magic != _MAGIC or (bit_count, hash_count) != (self.bit_count, self.hash_count):
+            self.file.close()
+            raise ValueError(f"{filename} is not a seen id filter of this capacity and error rate")
+        self.bits = mmap.mmap(self.file.fileno(), 0)
+        self._offset = _HEADER.size
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        first_hash = int.from_bytes(digest[:8], "little")
+        second_hash = int.from_bytes(digest[8:], "little") | 1
+        # double hashing, the k positions are first + i * second
+        return [(first_hash + index * second_hash) % self.bit_count for index in range(self.hash_count)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        offset = self._offset
+        for position in self._positions(key):
+            if not bits[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def add(self, key):
+        bits = self.bits
+        offset = self._offset
+        added = False
+        for position in self._positions(key):
+            index = offset + (position >> 3)
+            mask = 1 << (position & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                added = True
+        if added:
+            self.count += 1
+            if self.file:
+                _COUNT.pack_into(bits, _COUNT_OFFSET, self.count)
+
+    def close(self):
+        if self.file:
+            self.bits.flush()
+            self.bits.close()
+            self.file.close()
+            self.file = None
@@ -18,15 +18,237 @@ PROXY_TIMEOUT = 10
 FORCE_RELEASE_LIMIT = 0
 # if no items are fetched, force release += 1 and old proxies will be released when force release > FORCE_RELEASE_LIMIT
 
+IDENTITY_WARMER_COUNT = 5
+IDENTITY_POOL_SIZE = 5
+# the amount of identity warmers, and the maximum amount of warmed up session identities waiting for a worker
+
+IDENTITY_MAX_USES = 50
+# a worker retires its session identity after scraping this amount of users with it, or as soon as it is throttled
+
+MWEIBO_BASE_URL = "https://m.weibo.cn"
+# the mobile weibo site, the benchmark points it to a local mock server
+
+PROXY_POOL_URL = "http://127.0.0.1:5010/all/?type=https"
+# the proxy pool api read by get_proxy_list_from_localhost
+
 MAXIMUM = 9999999999
 RANGE_FROM = 0
 RANGE_TO = MAXIMUM
 LIMIT = 1000000
+
+UID_DB_FILE = "/media/scott/ScottTang/backup/weibo.db"
+UID_TABLE_NAME = "weibo_phone"
+UID_COLUMN = "uid"
+# the sqlite table that the uids are read from
+
+UID_SOURCE_FILE = None
+# path to a .txt (one uid per line) or .csv file. If set, uids are read from it instead of UID_DB_FILE
+
+UID_CHUNK_SIZE = 1000
+# the amount of uids read from the source at a time
+
 CSV_OUTPUT_FOLDER = "./local_storage/"
+OUTPUT_SINK = "csv"
+# how the rows are saved. "csv", "sqlite" (table weibo) or "parquet" (requires pyarrow)
+
+OUTPUT_BATCH_SIZE = 5000
+# the sqlite sink inserts and the parquet sink writes a row group every this amount of rows
+
+OUTPUT_ROTATE_BYTES = 0
+OUTPUT_ROTATE_SECONDS = 0
+# if not 0, the output is split into numbered files when a file is larger than OUTPUT_ROTATE_BYTES or older than OUTPUT_ROTATE_SECONDS
+
+OUTPUT_COMPRESSION = "zstd"
+# compression codec of the parquet sink
+
 ERROR_LOG_NAME = "weibo_error_log.txt"
 PROXY_LOG_NAME = "weibo_proxy_log.txt"
 LOG_OUTPUT_FOLDER = "./logs/"
-MAXIMUM_PROXY_WORKER_COUNT = 800
+
+PROXY_CHECKER_COUNT = 50
+# the amount of proxy checkers, also the maximum amount of proxy checks at once
+
+PROXY_REVALIDATE_INTERVAL = 300
+# an idle proxy that has not been checked or used successfully for this amount of seconds is checked again
+
+PROXY_CACHE_FILE = CSV_OUTPUT_FOLDER + "weibo_proxy_cache.json"
+# the known proxies and their health records are saved here when proxy boss gets off work and loaded when he starts,
+# so the workers can start right away. None to turn it off
+
+PROXY_CACHE_MAX_AGE = 6 * 3600
+# a proxy cache older than this amount of seconds is not loaded
+
+PROXY_BROKER_URL = None
+# set by weibo_scraper_launcher for its shards: the proxies are checked by the proxy broker at this url instead of proxy boss
+
+PROXY_BROKER_BATCH = 20
+# the amount of checked proxies a shard asks the proxy broker for when it runs low
+
+PROXY_BROKER_LEASE_TTL = 60
+# the proxies handed to a shard stay leased by the proxy broker for this amount of seconds, the shard renews them
+# every third of it. The proxies of a shard that stopped renewing, eg. it died, are checked again and handed to the others
+
+LOG_LEVEL = 20
+# lines below this level are not logged. 10: debug, 20: info, 30: warning, 40: error
+
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 1
+# buffered log lines are written when LOG_BATCH_SIZE lines are waiting or every LOG_FLUSH_INTERVAL seconds
+
+LOG_BUFFER_LIMIT = 20000
+# if this amount of lines are waiting, the logging coroutine writes them itself
+
+LOG_RATE_LIMIT = 20
+LOG_RATE_LIMIT_INTERVAL = 60
+# repeated lines with the same rate limit key are logged at most LOG_RATE_LIMIT times per LOG_RATE_LIMIT_INTERVAL seconds
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+# the metrics are served at http://METRICS_HOST:METRICS_PORT/metrics in the prometheus text format, eg. 9101. None to turn it off
+
+METRICS_INTERVAL = 10
+METRICS_SNAPSHOT_NAME = "weibo_metrics.jsonl"
+# every METRICS_INTERVAL seconds a json snapshot of the metrics is appended to this file in LOG_OUTPUT_FOLDER, None to turn it off
+
+TRACE_FILE = None
+# path to write the traces of the users to, eg. LOG_OUTPUT_FOLDER + "weibo_trace.json". A trace has a span for every stage of a user:
+# proxy and rate limiter waits, every request with its proxy and retry, hedges, parsing and results queue waits. None to turn it off
+
+TRACE_FORMAT = "chrome"
+# "chrome": the trace event format, open the file in chrome://tracing or https://ui.perfetto.dev. "jsonl": one span per line
+
+TRACE_SAMPLE_RATE = 0.01
+# the share of the users that are traced
+
+TRACE_SLOW_USER_SECONDS = None
+# if set, eg. 120, the trace of a user that takes longer than this amount of seconds is written too, whatever the sample rate.
+# For this every user is recorded while it is scraped, so the sample rate no longer bounds the cost. None to only trace the sampled users
+
+LOOP_LAG_INTERVAL = 0.25
+# the event loop lag, how much later than asked a sleeping coroutine wakes up, is sampled every this amount of seconds. None to turn it off
+
+OFFLOAD_PROCESSES = 0
+# if not 0, the timeline pages and detail pages are parsed in a pool of this amount of processes while the event loop lags,
+# so the parsing does not hold up the responses of the other workers. 0 to always parse on the event loop
+
+OFFLOAD_LAG_THRESHOLD = 0.05
+# the parsing moves to the pool when the average loop lag rises above this amount of seconds, and back below half of it
+
+OFFLOAD_BATCH_SIZE = 16
+OFFLOAD_BATCH_DELAY = 0.005
+# pages are sent to the pool OFFLOAD_BATCH_SIZE at a time, or after waiting OFFLOAD_BATCH_DELAY seconds for a full batch
+
+STATE_DB_FILE = CSV_OUTPUT_FOLDER + "weibo_state.db"
+# the local sqlite database that keeps the crawl state between runs, eg. the newest scraped weibo of every user
+
+STATE_COMMIT_INTERVAL = 100
+# state writes are committed every this amount of writes. The shards of weibo_scraper_launcher share the database and commit every write
+
+INCREMENTAL_CRAWL = False
+# if True, a user's timeline is only paginated until the newest weibo scraped in a previous run
+
+USER_INDEX_TTL = 7 * 24 * 3600
+# the containerid and post count of a user are kept in STATE_DB_FILE for this amount of seconds, and in the meantime
+# the worker goes straight to the user's timeline without fetching getIndex. 0 to turn it off
+
+SCHEDULE_WINDOW = 10000
+# the uids are read this amount at a time and handed to the workers longest timeline first, by the post counts
+# in the user index, so the heavy users do not start at the end of the crawl. 1 to keep the order of the source.
+# The first window is one uid per worker, so the workers start right away, and the windows double up to this size
+
+SCHEDULE_UNKNOWN_POST_COUNT = 100
+# the post count assumed for a user that is not in the user index
+
+SEEN_ID_CAPACITY = 0
+SEEN_ID_ERROR_RATE = 1e-4
+# if not 0, the ids of the written weibos are kept in a bloom filter, and a weibo whose id is in it is neither fetched nor written again.
+# The filter takes about 2.4 bytes per id at an error rate of 1e-4, a weibo is wrongly skipped with about this probability
+# while the filter holds at most SEEN_ID_CAPACITY ids. Size it for all the weibos of the crawls sharing it, eg. 100 per user:
+# once it holds SEEN_ID_CAPACITY ids it is full, a warning is logged and no more weibos are skipped by it
+
+SEEN_ID_FILE = None
+# path to keep the filter in, eg. CSV_OUTPUT_FOLDER + "weibo_seen_ids.bloom", so the weibos of previous crawls are skipped too.
+# It only matches a filter of the same SEEN_ID_CAPACITY and SEEN_ID_ERROR_RATE
+
+JOB_DB_FILE = None
+# path to a sqlite job table, eg. CSV_OUTPUT_FOLDER + "weibo_jobs.db". If set, the uids are added to it and claimed from it
+# with leases, so a crawl can be resumed and several processes or hosts sharing the file can pull from it.
+# The hosts need a filesystem with working file locks, eg. NFS with its lock manager
+
+JOB_LEASE_SECONDS = 1800
+# a claimed uid is handed out again if it is not finished and its lease is not renewed within this amount of seconds
+
+JOB_MAX_ATTEMPTS = 3
+# a uid is not handed out again after it has been claimed this amount of times
+
+JOB_CLAIM_SIZE = 100
+# the amount of uids claimed at a time
+
+JOB_POLL_INTERVAL = 10
+# seconds to wait before claiming again when the remaining uids are leased by other processes
+
+JOB_COMMIT_INTERVAL = 30
+# finished uids are marked in the job table and their high water marks are saved every this amount of seconds,
+# after the sink has flushed their rows. The parquet sink starts a new part every time, as a parquet file is only readable once it is closed
+
+CONNECTION_LIMIT = 1000
+# the maximum amount of open connections of the connection pool shared by all workers
+
+CONNECTION_LIMIT_PER_PROXY = 10
+# the maximum amount of open connections to one host through one proxy
+
+KEEPALIVE_TIMEOUT = 30
+# idle connections are kept in the pool for this amount of seconds so the next user can reuse them
+
+DNS_CACHE_TTL = 600
+# dns results are cached for this amount of seconds
+
+RESULTS_QUEUE_SIZE = 200
+# the maximum amount of pages waiting for the writer. If it is full, the workers wait for the writer to catch up
+
+RATE_LIMIT_INITIAL = 1
+RATE_LIMIT_MIN = 0.1
+RATE_LIMIT_MAX = 10
+# requests per second allowed through one proxy at the start, at the slowest and at the fastest
+
+RATE_LIMIT_INCREASE = 0.2
+RATE_LIMIT_DECREASE = 0.5
+# every clean response adds RATE_LIMIT_INCREASE to a proxy's rate, every throttled one multiplies it by RATE_LIMIT_DECREASE
+
+RATE_LIMIT_BURST = 3
+# the amount of requests a proxy can send at once after it has been idle
+
+PAGE_PARALLEL_COUNT = 1
+PAGE_PARALLEL_MIN_POSTS = 500
+# the timeline of a user with at least PAGE_PARALLEL_MIN_POSTS posts is fetched by page number, up to PAGE_PARALLEL_COUNT pages
+# at once through different idle proxies, instead of one page after another with since_id. 1 turns it off, eg. 4 to turn it on
+
+DETAIL_CONCURRENCY_PER_USER = 4
+DETAIL_CONCURRENCY_PER_PROXY = 8
+# the maximum amount of "全文" detail pages fetched at the same time for one user and through one proxy
+
+HEDGE_BUDGET = 0
+HEDGE_BURST = 10
+# a slow request is sent again through a second proxy, every request earns HEDGE_BUDGET of a hedge and at most
+# HEDGE_BURST hedges are saved up, so the hedges add at most this share of requests. 0 turns it off, eg. 0.05 to turn it on
+
+HEDGE_QUANTILE = 0.95
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# a request is hedged when it is slower than HEDGE_QUANTILE of the latest HEDGE_WINDOW responses of its endpoint,
+# once there are HEDGE_MIN_SAMPLES of them
+
+PROXY_EWMA_ALPHA = 0.3
+# weight of the newest response time in a proxy's moving average latency
+
+PROXY_BREAKER_THRESHOLD = 3
+# if a proxy failed this amount of times in a row, it will not be handed out for PROXY_COOLDOWN seconds
+
+PROXY_COOLDOWN = 60
+
+PROXY_EVICT_MIN_ATTEMPTS = 10
+PROXY_EVICT_SUCCESS_RATE = 0.3
+# if a proxy has been used PROXY_EVICT_MIN_ATTEMPTS times and its success rate is below PROXY_EVICT_SUCCESS_RATE, it will be dropped from the pool
 
 def date_to_timestamp(date_str):
     try:
@@ -37,8 +259,7 @@ def date_to_timestamp(date_str):
 
 
 async def get_proxy_list_from_localhost(session):
-    localhost_proxy_url = "http://127.0.0.1:5010/all/?type=https"
-    async with session.get(localhost_proxy_url) as resp:
+    async with session.get(PROXY_POOL_URL) as resp:
         text = await resp.text()
         checkproxy_list = orjson.loads(text)
     checkproxy_list = sorted(checkproxy_list, key=lambda x: date_to_timestamp(x['last_time']), reverse=True)
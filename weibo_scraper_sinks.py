@@ -0,0 +1,344 @@
+import asyncio
+import csv
+import glob
+import itertools
+import os
+import sqlite3
+import time
+
+import aiocsv
+import aiofiles
+
+from weibo_scraper_settings import OUTPUT_BATCH_SIZE, OUTPUT_ROTATE_BYTES, OUTPUT_ROTATE_SECONDS, OUTPUT_COMPRESSION
+
+
+WEIBO_ROW_FIELDS = [
+    'url_id', # weibo id
+    'text', # weibo text
+    'text_length', # weibo text length
+    'user_id', # weibo owner
+    'reposts_count',
+    'comments_count',
+    'attitudes_count',
+    'pic_num',
+    'pic_id',
+    'is_retweet', # if this weibo is a retweet
+    'retweet_id', # if not, then None; if is, then id of the retweeted weibo
+    'date_string', # eg. Dec 27 14:55:18 +0800 2023
+    'timestamp'
+]
+# the fields of the rows made by get_row_from_mobile_data
+
+
+class RotatingSink:
+    """
+    Description:
+        This is the base of the output sinks. A sink takes the rows of get_row_from_mobile_data and writes them to
+        output_location + extension. If rotate_bytes or rotate_seconds is set, the output is split into numbered
+        parts, eg. weibo_final_0_0000.csv, and a new part is started when the current one is larger than rotate_bytes
+        or older than rotate_seconds.
+        If resume, eg. a crawl resumed from its job table, the rows already written are kept: the output is appended to,
+        the numbered parts go on after the existing ones, and a file that cannot be appended to is continued in a new part.
+
+    Subclasses implement:
+        _open_file(path), _write(rows), _flush(), _close_file(), _size(), and read_rows(path) for merge_outputs
+    """
+    extension = ""
+    appendable = True
+    # if an existing file can be opened to write more rows to it
+
+    def __init__(self, output_location, rotate_bytes=OUTPUT_ROTATE_BYTES, rotate_seconds=OUTPUT_ROTATE_SECONDS, resume=False):
+        self.output_location = output_location
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.resume = resume
+        self.paths = []
+        self._part = 0
+        if resume:
+            numbered_paths = [path for path in self.get_paths(output_location) if path != self._single_path()]
+            if numbered_paths:
+                self._part = int(numbered_paths[-1][-len(self.extension) - 4:-len(self.extension)]) + 1
+        self._opened_at = None
+        self._is_open = False
+
+    async def open(self):
+        path = self._next_path()
+        self.paths.append(path)
+        await self._open_file(path)
+        self._opened_at = time.monotonic()
+        self._is_open = True
+
+    async def write_rows(self, rows):
+        # after a rotation, the next part is opened by the next rows so no empty part is left at the end
+        if not self._is_open:
+            await self.open()
+        await self._write(rows)
+        if await self._should_rotate():
+            await self.close()
+
+    async def flush(self):
+        """
+        DESCRIPTION:
+            hand the buffered rows to the file. A parquet file is only readable after it is closed
+        """
+        if self._is_open:
+            await self._flush()
+
+    async def commit(self):
+        """
+        DESCRIPTION:
+            make the rows written so far readable after a crash, before their uids are marked done in the job table
+        """
+        await self.flush()
+
+    async def close(self):
+        if self._is_open:
+            self._is_open = False
+            await self._close_file()
+
+    @classmethod
+    def get_paths(cls, output_location):
+        """
+        DESCRIPTION:
+            the existing output files of output_location, the numbered parts in order
+        """
+        paths = sorted(glob.glob(f"{glob.escape(output_location)}_[0-9][0-9][0-9][0-9]{cls.extension}"))
+        single_path = f"{output_location}{cls.extension}"
+        if os.path.exists(single_path):
+            paths.insert(0, single_path)
+        return paths
+
+    def _single_path(self):
+        return f"{self.output_location}{self.extension}"
+
+    def _next_path(self):
+        # a file that cannot be appended to is not opened again, eg. a parquet file closed by commit
+        if self.rotate_bytes or self.rotate_seconds or \
+                not self.appendable and (self.resume or self.paths) and os.path.exists(self._single_path()):
+            path = f"{self.output_location}_{self._part:04d}{self.extension}"
+            self._part += 1
+        else:
+            path = f"{self.output_location}{self.extension}"
+        return path
+
+    async def _should_rotate(self):
+        if self.rotate_seconds and time.monotonic() - self._opened_at >= self.rotate_seconds:
+            return True
+        if self.rotate_bytes and await self._size() >= self.rotate_bytes:
+            return True
+        return False
+
+
+class CsvSink(RotatingSink):
+    """
+    Description:
+        writes the rows to csv files with aiocsv, every file starts with the header WEIBO_ROW_FIELDS.
+        A resumed output is appended to
+    """
+    extension = ".csv"
+
+    async def _open_file(self, path):
+        self.file = await aiofiles.open(path, 'a' if self.resume else 'w')
+        self.writer = aiocsv.AsyncWriter(self.file)
+        if not await self.file.tell():
+            await self.writer.writerow(WEIBO_ROW_FIELDS)
+
+    async def _write(self, rows):
+        await self.writer.writerows(rows)
+
+    async def _flush(self):
+        await self.file.flush()
+
+    async def _close_file(self):
+        await self.file.close()
+
+    async def _size(self):
+        return await self.file.tell()
+
+    @staticmethod
+    def read_rows(path):
+        with open(path, newline='') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            while rows := list(itertools.islice(reader, OUTPUT_BATCH_SIZE)):
+                yield rows
+
+
+class SqliteSink(RotatingSink):
+    """
+    Description:
+        writes the rows to the table weibo of sqlite databases.
+        Rows are buffered and inserted OUTPUT_BATCH_SIZE at a time with executemany in one transaction,
+        in a thread so the event loop keeps running.
+    """
+    extension = ".db"
+    _SQL_CREATE_TABLE = f"CREATE TABLE IF NOT EXISTS weibo ({', '.join(WEIBO_ROW_FIELDS)})"
+    _SQL_INSERT = f"INSERT INTO weibo VALUES ({', '.join('?' * len(WEIBO_ROW_FIELDS))})"
+
+    async def _open_file(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(self._SQL_CREATE_TABLE)
+        self.conn.commit()
+        self.buffer = []
+
+    async def _write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= OUTPUT_BATCH_SIZE:
+            await self._flush()
+
+    async def _close_file(self):
+        await self._flush()
+        self.conn.close()
+
+    async def _size(self):
+        return os.path.getsize(self.path)
+
+    async def _flush(self):
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        await asyncio.to_thread(self._insert, rows)
+
+    def _insert(self, rows):
+        with self.conn:
+            self.conn.executemany(self._SQL_INSERT, rows)
+
+    @staticmethod
+    def read_rows(path):
+        # merge_outputs reads every batch in a thread of its own
+        conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            cursor = conn.execute("SELECT * FROM weibo")
+            while rows := cursor.fetchmany(OUTPUT_BATCH_SIZE):
+                yield rows
+        finally:
+            conn.close()
+
+
+class ParquetSink(RotatingSink):
+    """
+    Description:
+        writes the rows to compressed parquet files, one row group per OUTPUT_BATCH_SIZE rows.
+        The counts are kept as strings because weibo returns values like "100万+" for them.
+        A parquet file cannot be appended to, so a resumed output goes on in a new part.
+        A parquet file is only readable once its footer is written, so commit closes the file and the next rows go to a new part.
+
+    Dependency:
+        pyarrow, it is only imported when this sink is used
+    """
+    extension = ".parquet"
+    appendable = False
+
+    async def _open_file(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("OUTPUT_SINK = 'parquet' requires pyarrow, install it with pip install pyarrow") from e
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ('url_id', pyarrow.string()),
+            ('text', pyarrow.string()),
+            ('text_length', pyarrow.int64()),
+            ('user_id', pyarrow.int64()),
+            ('reposts_count', pyarrow.string()),
+            ('comments_count', pyarrow.string()),
+            ('attitudes_count', pyarrow.string()),
+            ('pic_num', pyarrow.int64()),
+            ('pic_id', pyarrow.string()),
+            ('is_retweet', pyarrow.bool_()),
+            ('retweet_id', pyarrow.string()),
+            ('date_string', pyarrow.string()),
+            ('timestamp', pyarrow.int64()),
+        ])
+        self.path = path
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=OUTPUT_COMPRESSION)
+        self.buffer = []
+
+    async def _write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= OUTPUT_BATCH_SIZE:
+            await self._flush()
+
+    async def commit(self):
+        await self.close()
+
+    async def _close_file(self):
+        await self._flush()
+        await asyncio.to_thread(self.parquet_writer.close)
+
+    async def _size(self):
+        return os.path.getsize(self.path)
+
+    async def _flush(self):
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        await asyncio.to_thread(self._write_row_group, rows)
+
+    def _write_row_group(self, rows):
+        columns = []
+        for index, field in enumerate(self.schema):
+            values = [row[index] for row in rows]
+            if field.type == self.pyarrow.string():
+                values = [None if value is None else str(value) for value in values]
+            columns.append(values)
+        self.parquet_writer.write_table(self.pyarrow.table(columns, schema=self.schema))
+
+    @staticmethod
+    def read_rows(path):
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=OUTPUT_BATCH_SIZE):
+            yield list(zip(*[column.to_pylist() for column in batch.columns]))
+
+
+_SINKS = {
+    "csv": CsvSink,
+    "sqlite": SqliteSink,
+    "parquet": ParquetSink,
+}
+
+
+def get_sink(sink_name, output_location, resume=False):
+    """
+    DESCRIPTION:
+        build the output sink
+
+    INPUT:
+        sink_name: "csv", "sqlite" or "parquet"
+        output_location: the output path without extension
+        resume: keep the rows already written to output_location, eg. the crawl is resumed from its job table
+    """
+    if sink_name not in _SINKS:
+        raise ValueError(f"unknown output sink {sink_name}, choose from {', '.join(_SINKS)}")
+    return _SINKS[sink_name](output_location, resume=resume)
+
+
+async def merge_outputs(sink_name, output_locations, merged_location):
+    """
+    DESCRIPTION:
+        merge the outputs of several runs, eg. the shards of weibo_scraper_launcher, into merged_location.
+        The rows are written through a new sink, so the merged output is rotated like any other output.
+        The files are read OUTPUT_BATCH_SIZE rows at a time in a thread.
+
+    INPUT:
+        sink_name: the OUTPUT_SINK the runs used
+        output_locations: the output paths of the runs without extension
+        merged_location: the merged output path without extension
+
+    OUTPUT:
+        the paths of the files that have been merged
+    """
+    sink_class = _SINKS[sink_name]
+    paths = [path for output_location in output_locations for path in sink_class.get_paths(output_location)]
+    sink = get_sink(sink_name, merged_location)
+    await sink.open()
+    try:
+        for path in paths:
+            batches = sink_class.read_rows(path)
+            while rows := await asyncio.to_thread(next, batches, None):
+                await sink.write_rows(rows)
+    finally:
+        await sink.close()
+    return paths
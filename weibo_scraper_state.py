@@ -0,0 +1,90 @@
+import sqlite3
+import time
+
+
+class StateStore:
+    """
+    Description:
+        This is the local sqlite database that keeps the crawl state between runs.
+        Writes are committed in batches of commit_interval, call commit() or close() to flush the rest.
+
+    Tables:
+        high_water_marks: the newest scraped weibo of every user
+            uid, # weibo owner
+            url_id, # id of the newest scraped weibo
+            timestamp # its timestamp
+        user_index: what the index of a user tells, so later runs can go straight to the timeline
+            uid,
+            containerid, # fid of the user's weibo container
+            post_count, # statuses_count of the user when it was looked up
+            updated # time.time() of the lookup
+    """
+
+    def __init__(self, db_file, commit_interval=100):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS high_water_marks "
+                          "(uid INTEGER PRIMARY KEY, url_id TEXT, timestamp INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_index "
+                          "(uid INTEGER PRIMARY KEY, containerid TEXT, post_count INTEGER, updated REAL)")
+        self.conn.commit()
+        self.commit_interval = commit_interval
+        self._pending_writes = 0
+
+    def get_high_water_mark(self, uid):
+        """
+        OUTPUT:
+            (url_id, timestamp) of the newest scraped weibo of the user, or None if the user was never scraped
+        """
+        return self.conn.execute("SELECT url_id, timestamp FROM high_water_marks WHERE uid = ?", (uid,)).fetchone()
+
+    def set_high_water_mark(self, uid, url_id, timestamp):
+        self.conn.execute("INSERT OR REPLACE INTO high_water_marks (uid, url_id, timestamp) VALUES (?, ?, ?)",
+                          (uid, str(url_id), timestamp))
+        self._written()
+
+    def get_user_index(self, uid, max_age):
+        """
+        OUTPUT:
+            (containerid, post_count) of the user, or None if it was never looked up or the lookup is older than max_age seconds
+        """
+        return self.conn.execute("SELECT containerid, post_count FROM user_index WHERE uid = ? AND updated >= ?",
+                                 (uid, time.time() - max_age)).fetchone()
+
+    def set_user_index(self, uid, containerid, post_count):
+        self.conn.execute("INSERT OR REPLACE INTO user_index (uid, containerid, post_count, updated) VALUES (?, ?, ?, ?)",
+                          (uid, str(containerid), post_count, time.time()))
+        self._written()
+
+    def get_post_counts(self, uids, max_age):
+        """
+        OUTPUT:
+            dict of uid: post_count of the users in uids whose index is known and not older than max_age seconds
+        """
+        post_counts = {}
+        uids = list(uids)
+        # sqlite limits the amount of parameters of a statement
+        for start in range(0, len(uids), 500):
+            chunk = uids[start:start + 500]
+            post_counts.update(self.conn.execute(
+                f"SELECT uid, post_count FROM user_index WHERE uid IN ({','.join('?' * len(chunk))}) "
+                "AND updated >= ? AND post_count IS NOT NULL", (*chunk, time.time() - max_age)))
+        return post_counts
+
+    def delete_user_index(self, uid):
+        self.conn.execute("DELETE FROM user_index WHERE uid = ?", (uid,))
+        self._written()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def _written(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_interval:
+            self.commit()
@@ -0,0 +1,203 @@
+import asyncio
+import contextvars
+import os
+import random
+import time
+
+import aiofiles
+import orjson
+
+from weibo_scraper_metrics import TRACES
+
+
+_CURRENT_TRACE = contextvars.ContextVar("weibo_trace", default=None)
+# the trace of the user the running task works for. The tasks started for the user, eg. the detail pages, inherit it
+
+
+class Trace:
+    """
+    DESCRIPTION:
+        the spans recorded for one user
+
+    DATA STRUCTURE:
+        uid,
+        sampled, # if the user was picked by the sample rate, otherwise it is only kept if it is slow
+        spans, # list of (name, start, duration, track, args), start is a unix timestamp
+        tracks # dict of id of the asyncio task: track number, every task the user is worked on in is a track of its own
+    """
+    __slots__ = ("uid", "sampled", "spans", "tracks")
+
+    def __init__(self, uid, sampled):
+        self.uid = uid
+        self.sampled = sampled
+        self.spans = []
+        self.tracks = {}
+
+    def add(self, name, start, end, args):
+        track = self.tracks.setdefault(id(asyncio.current_task()), len(self.tracks))
+        self.spans.append((name, start, end - start, track, args))
+
+
+class Span:
+    """
+    DESCRIPTION:
+        a timed stage of a trace, used as a context manager. The args are saved with it, eg. the proxy and the retry,
+        more can be added with set() before it ends. If the stage raises, the error class is saved as args["error"]
+    """
+    __slots__ = ("trace", "name", "args", "start")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.time(), self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class _NoSpan:
+    """
+    DESCRIPTION:
+        what trace_span returns when the user is not traced, it does nothing
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def trace_span(name, **args):
+    """
+    DESCRIPTION:
+        a span of the trace of the current user, or NO_SPAN if the user is not traced, which costs a context variable lookup
+    """
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, args)
+
+
+class _UserTrace:
+    """
+    DESCRIPTION:
+        the context manager of Tracer.user. It makes the trace current while the user is scraped,
+        and hands it to the tracer when the user is done
+    """
+
+    def __init__(self, tracer, uid, sampled):
+        self.tracer = tracer
+        self.trace = Trace(uid, sampled)
+        self.span = Span(self.trace, "user", {"uid": uid})
+        self.token = None
+
+    def __enter__(self):
+        self.token = _CURRENT_TRACE.set(self.trace)
+        return self.span.__enter__()
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.span.__exit__(exc_type, exc, traceback)
+        _CURRENT_TRACE.reset(self.token)
+        self.tracer.finish(self.trace, time.time() - self.span.start)
+        return False
+
+
+class Tracer:
+    """
+    Description:
+        This records where the time of a user goes: the proxy waits, the rate limiter waits, every request
+        with its proxy and retry, the hedges, the parsing and the results queue waits, as spans of the user's trace.
+        A user is traced with the probability sample_rate. If slow_user_seconds is set, every user is recorded
+        while it is scraped, and the trace of a user that took longer is kept too, so the slow users can be looked into
+        at a low sample rate. The other traces are dropped when the user is done.
+        The kept traces are appended to filename every flush_interval seconds by run(), in trace_format:
+            "chrome": the trace event format, open the file in chrome://tracing or https://ui.perfetto.dev.
+                      Every user is a process there, and every task the user was worked on in is a thread
+            "jsonl": one span per line
+        If filename is None, nothing is recorded.
+    """
+
+    def __init__(self, filename=None, trace_format="chrome", sample_rate=0.01, slow_user_seconds=None, flush_interval=1):
+        if trace_format not in ("chrome", "jsonl"):
+            raise ValueError(f"unknown trace format {trace_format}, use chrome or jsonl")
+        self.filename = filename
+        self.trace_format = trace_format
+        self.sample_rate = sample_rate
+        self.slow_user_seconds = slow_user_seconds
+        self.flush_interval = flush_interval
+        self._events = []
+
+    def user(self, uid):
+        """
+        DESCRIPTION:
+            the context manager to scrape a user in, the spans recorded in it and in the tasks started in it go to the user's trace.
+            It gives the "user" span, or NO_SPAN if the user is not recorded
+        """
+        if not self.filename:
+            return NO_SPAN
+        sampled = random.random() < self.sample_rate
+        if not sampled and not self.slow_user_seconds:
+            return NO_SPAN
+        return _UserTrace(self, uid, sampled)
+
+    def finish(self, trace, duration):
+        if trace.sampled:
+            TRACES.inc("sampled")
+        elif duration >= self.slow_user_seconds:
+            TRACES.inc("slow")
+        else:
+            return
+        if self.trace_format == "chrome":
+            self._events.append({"name": "process_name", "ph": "M", "pid": trace.uid, "args": {"name": f"uid {trace.uid}"}})
+            for name, start, span_duration, track, args in trace.spans:
+                self._events.append({"name": name, "cat": "weibo", "ph": "X", "ts": int(start * 1e6), "dur": int(span_duration * 1e6),
+                                     "pid": trace.uid, "tid": track, "args": args})
+        else:
+            for name, start, span_duration, track, args in trace.spans:
+                self._events.append({"uid": trace.uid, "name": name, "start": start, "duration": span_duration,
+                                     "track": track, "args": args})
+
+    async def run(self):
+        """
+        Life Cycle:
+            tracer is started by the scraper engine and cancelled when it stops, he flushes one last time when he is cancelled.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+    async def flush(self):
+        if not self._events:
+            return
+        events, self._events = self._events, []
+        if self.trace_format == "chrome":
+            # the closing bracket is optional in the trace event format, so the file can be appended to
+            lines = [orjson.dumps(event) + b",\n" for event in events]
+            if not os.path.exists(self.filename) or not os.path.getsize(self.filename):
+                lines.insert(0, b"[\n")
+        else:
+            lines = [orjson.dumps(event) + b"\n" for event in events]
+        async with aiofiles.open(self.filename, 'ab') as file:
+            await file.write(b"".join(lines))
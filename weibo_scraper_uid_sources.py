@@ -0,0 +1,102 @@
+import asyncio
+import csv
+import itertools
+import sqlite3
+
+from weibo_scraper_settings import UID_SOURCE_FILE, UID_DB_FILE, UID_TABLE_NAME, UID_COLUMN, UID_CHUNK_SIZE
+
+
+async def sqlite_uid_source(db_file, table_name, range_from, range_to, limit, uid_column="uid", chunk_size=UID_CHUNK_SIZE):
+    """
+    DESCRIPTION:
+        yield uids from a sqlite table chunk by chunk.
+        Pages by rowid (keyset pagination) so that every chunk is an index seek in database order,
+        no matter whether uid_column is indexed.
+        Each chunk is read in a thread, so the event loop keeps running while sqlite works.
+
+    INPUT:
+        db_file: path to the sqlite database
+        table_name, uid_column: where the uids are
+        range_from, range_to: only uids between them (inclusive) are yielded
+        limit: yield at most this amount of uids
+        chunk_size: the amount of rows read per query
+
+    OUTPUT:
+        async generator of uids
+    """
+    sql_fetch_uid_chunk = (f"SELECT rowid, {uid_column} FROM {table_name} "
+                           f"WHERE rowid > ? AND {uid_column} BETWEEN ? AND ? ORDER BY rowid LIMIT ?")
+    conn = sqlite3.connect(db_file, check_same_thread=False)
+    try:
+        last_rowid = -1
+        remaining = limit
+        while remaining > 0:
+            rows = await asyncio.to_thread(_fetch_all, conn, sql_fetch_uid_chunk,
+                                           (last_rowid, range_from, range_to, min(chunk_size, remaining)))
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            remaining -= len(rows)
+            for _, uid in rows:
+                yield uid
+    finally:
+        conn.close()
+
+
+async def file_uid_source(filename, range_from, range_to, limit, uid_column="uid", chunk_size=UID_CHUNK_SIZE):
+    """
+    DESCRIPTION:
+        yield uids from a plain text file with one uid per line, or from a csv file.
+        For csv files, the uid_column is used if the first row is a header, otherwise the first column.
+        Lines that are not a number are skipped.
+
+    INPUT:
+        filename: path to the .txt or .csv file
+        range_from, range_to, limit, chunk_size: same as sqlite_uid_source
+
+    OUTPUT:
+        async generator of uids
+    """
+    with open(filename, newline='') as file:
+        reader = csv.reader(file)
+        column = 0
+        remaining = limit
+        first_chunk = True
+        while remaining > 0:
+            rows = await asyncio.to_thread(_read_chunk, reader, chunk_size)
+            if not rows:
+                break
+            if first_chunk:
+                first_chunk = False
+                if uid_column in rows[0]:
+                    column = rows[0].index(uid_column)
+                    rows = rows[1:]
+            for row in rows:
+                try:
+                    uid = int(row[column])
+                except (IndexError, ValueError):
+                    continue
+                if range_from <= uid <= range_to:
+                    yield uid
+                    remaining -= 1
+                    if remaining < 1:
+                        break
+
+
+def get_uid_source(range_from, range_to, limit):
+    """
+    DESCRIPTION:
+        build the uid source configured in weibo_scraper_settings.
+        UID_SOURCE_FILE is used if it is set, otherwise the sqlite table UID_TABLE_NAME in UID_DB_FILE
+    """
+    if UID_SOURCE_FILE:
+        return file_uid_source(UID_SOURCE_FILE, range_from, range_to, limit, UID_COLUMN)
+    return sqlite_uid_source(UID_DB_FILE, UID_TABLE_NAME, range_from, range_to, limit, UID_COLUMN)
+
+
+def _fetch_all(conn, sql, parameters):
+    return conn.execute(sql, parameters).fetchall()
+
+
+def _read_chunk(reader, chunk_size):
+    return list(itertools.islice(reader, chunk_size))
@@ -1,6 +1,25 @@
 
 
-from weibo_scraper_settings import LOG_OUTPUT_FOLDER
+import asyncio
+import calendar
+import functools
+import html
+import re
+import time
+from datetime import datetime
+from weibo_scraper_settings import LOG_OUTPUT_FOLDER, LOG_LEVEL, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_BUFFER_LIMIT, \
+    LOG_RATE_LIMIT, LOG_RATE_LIMIT_INTERVAL
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+_LOG_LEVEL_NAMES = {LOG_DEBUG: "DEBUG", LOG_INFO: "INFO", LOG_WARNING: "WARNING", LOG_ERROR: "ERROR"}
+
+_HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+_WEIBO_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+_MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+           "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
 
 write_files = {}
 
@@ -36,34 +55,127 @@ async def append_string_to_file(string, filename):
 
 
 log_files = {}
+_log_buffer = []
+_log_buffer_ready = None
+_log_writer_task = None
+_log_flush_lock = None
+_log_rate_limits = {}
+
+async def append_new_line_to_log(output_string, filename, level=LOG_INFO, rate_limit_key=None):
+    """
+    DESCRIPTION:
+        add a timestamped line to the log buffer. The lines are written in batches by the background log writer,
+        so logging does not wait for the disk.
+
+    INPUT: 
+        output_string: the line to log
+        filename: the log file in LOG_OUTPUT_FOLDER
+        level: LOG_DEBUG, LOG_INFO, LOG_WARNING or LOG_ERROR, lines below LOG_LEVEL are dropped
+        rate_limit_key: lines with the same key are logged at most LOG_RATE_LIMIT times per LOG_RATE_LIMIT_INTERVAL seconds,
+            the amount of suppressed lines is logged when the interval is over
+    """
+    global _log_buffer, _log_buffer_ready, _log_writer_task
+    if level < LOG_LEVEL:
+        return
+    if rate_limit_key is not None and not _log_rate_limit_allows(rate_limit_key, filename, level):
+        return
+
+    _log_buffer.append((filename, f"{datetime.now().isoformat(' ')} {_LOG_LEVEL_NAMES.get(level, level)} {output_string}\n"))
+    if _log_writer_task is None or _log_writer_task.done():
+        _log_buffer_ready = asyncio.Event()
+        _log_writer_task = asyncio.create_task(log_writer())
+    if len(_log_buffer) >= LOG_BUFFER_LIMIT:
+        await flush_logs()
+    elif len(_log_buffer) >= LOG_BATCH_SIZE:
+        _log_buffer_ready.set()
+
+
+def _log_rate_limit_allows(rate_limit_key, filename, level):
+    global _log_rate_limits, _log_buffer
+    now = time.monotonic()
+    window = _log_rate_limits.get(rate_limit_key)
+    if window is None or now - window[0] > LOG_RATE_LIMIT_INTERVAL:
+        if window and window[2]:
+            _log_buffer.append((filename, f"{datetime.now().isoformat(' ')} {_LOG_LEVEL_NAMES.get(level, level)} "
+                                          f"{window[2]} lines of {rate_limit_key} suppressed\n"))
+        # window: [start time, logged lines, suppressed lines]
+        window = [now, 0, 0]
+        _log_rate_limits[rate_limit_key] = window
+    if window[1] < LOG_RATE_LIMIT:
+        window[1] += 1
+        return True
+    window[2] += 1
+    return False
+
+
+async def log_writer():
+    """
+    Description:
+        This function is the background log writer.
+        It writes the buffered lines every LOG_FLUSH_INTERVAL seconds, or earlier when LOG_BATCH_SIZE lines are waiting.
+
+    Life Cycle:
+        log writer is started by the first log line and cancelled by close_files.
+        A flush he has started is shielded, so the lines he has taken from the buffer are still written when he is cancelled
+    """
+    global _log_buffer_ready
+    while True:
+        try:
+            await asyncio.wait_for(_log_buffer_ready.wait(), LOG_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _log_buffer_ready.clear()
+        await asyncio.shield(flush_logs())
+
 
-async def append_new_line_to_log(output_string, filename):
-    global log_files
+async def flush_logs():
+    """
+    DESCRIPTION:
+        write all the buffered log lines with one write and flush per log file.
+        One flush runs at a time, so the batches are written in order and a log file is opened once
+    """
+    global log_files, _log_buffer, _log_flush_lock
     try:
         aiofiles
     except NameError:
         import aiofiles
 
-    try:
-        datetime
-    except NameError:
-        from datetime import datetime
-
-    if filename not in log_files:
-        log_files[filename] = await aiofiles.open(LOG_OUTPUT_FOLDER + filename, 'a+')
-    await log_files[filename].write(datetime.now().isoformat(' ') + " " + output_string + "\n")
-    await log_files[filename].flush()
+    if _log_flush_lock is None:
+        _log_flush_lock = asyncio.Lock()
+    async with _log_flush_lock:
+        if not _log_buffer:
+            return
+        lines, _log_buffer = _log_buffer, []
+        lines_per_file = {}
+        for filename, line in lines:
+            lines_per_file.setdefault(filename, []).append(line)
+        for filename, file_lines in lines_per_file.items():
+            if filename not in log_files:
+                log_files[filename] = await aiofiles.open(LOG_OUTPUT_FOLDER + filename, 'a+')
+            await log_files[filename].write("".join(file_lines))
+            await log_files[filename].flush()
 
 
 async def close_files():
-    global write_files, log_files
+    global write_files, log_files, _log_writer_task, _log_flush_lock
 
+    if _log_writer_task is not None:
+        log_writer_task, _log_writer_task = _log_writer_task, None
+        log_writer_task.cancel()
+        await asyncio.gather(log_writer_task, return_exceptions=True)
+    # waits for a flush the log writer has started, then writes what is left
+    await flush_logs()
     for fileobj in log_files:
         await log_files[fileobj].close()
     for fileobj in write_files:
         await write_files[fileobj].close()
     for fileobj in append_files:
         await append_files[fileobj].close()
+    log_files.clear()
+    write_files.clear()
+    append_files.clear()
+    # the next crawl of the process may run in another event loop
+    _log_flush_lock = None
 
 
 def load_json_from_file(filename):
@@ -128,17 +240,50 @@ def empty_queue(q):
 def extracted_text_from_html(text_html):
     """
     DESCRIPTION:
-        a fast version of html.text with pure regex
+        a fast version of html.text with a precompiled regex.
+        The regex and the entity decoding are skipped when the text has no tag or no entity
 
     INPUT: 
         html data in string
     
     OUTPUT: 
-        html data without tags and &xx; charactors
+        html data without tags, &xx; charactors are decoded, eg. &amp; becomes &
     """
+    if '<' in text_html:
+        text_html = _HTML_TAG_PATTERN.sub('', text_html)
+    if '&' in text_html:
+        text_html = html.unescape(text_html)
+    return text_html
+
+
+def get_timestamp_from_date_string(date_string):
+    """
+    DESCRIPTION:
+        converts mobile weibo's created_at, eg. Wed Dec 27 14:55:18 +0800 2023, to a unix timestamp.
+        The fixed format is split by hand instead of datetime.strptime, which is slow and depends on the locale,
+        and the start of every day is cached. Other formats fall back to strptime.
+
+    OUTPUT: 
+        int timestamp, or None if date_string is empty or cannot be parsed
+    """
+    if not date_string:
+        return None
     try:
-        re
-    except NameError:
-        import re
-    return re.sub(r'(&[a-z]*?;)|(<[^>]*>)', '', text_html)
+        _, month, day, clock, zone, year = date_string.split(' ')
+        hour, minute, second = clock.split(':')
+        return _get_day_start_timestamp(year, month, day, zone) + int(hour) * 3600 + int(minute) * 60 + int(second)
+    except (ValueError, KeyError, IndexError):
+        pass
+    try:
+        return int(datetime.strptime(date_string, _WEIBO_DATE_FORMAT).timestamp())
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_day_start_timestamp(year, month, day, zone):
+    offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+    if zone[0] == '-':
+        offset = -offset
+    return calendar.timegm((int(year), _MONTHS[month], int(day), 0, 0, 0)) - offset
 
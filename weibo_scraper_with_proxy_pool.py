@@ -1,22 +1,45 @@
 import asyncio
-from datetime import datetime
-import random
+import collections
+import os
 import re
-import sqlite3
-import aiocsv
-import aiofiles
+import time
 import aiohttp
 import orjson
 from weibo_scraper_settings import *
-from weibo_scraper_utils import append_new_line_to_log, close_files, extracted_text_from_html
+from weibo_scraper_utils import append_new_line_to_log, close_files, extracted_text_from_html, get_timestamp_from_date_string, \
+    LOG_DEBUG, LOG_WARNING, LOG_ERROR
+from weibo_scraper_proxy_registry import ProxyRegistry
+from weibo_scraper_uid_sources import get_uid_source
+from weibo_scraper_state import StateStore
+from weibo_scraper_sinks import get_sink
+from weibo_scraper_rate_limiter import AdaptiveRateLimiter
+from weibo_scraper_jobs import JobTable, JobResult, job_uid_source
+from weibo_scraper_seen_ids import BloomFilter
+from weibo_scraper_identities import SessionIdentity, IdentityPool
+from weibo_scraper_hedging import HedgePolicy
+from weibo_scraper_offload import LoopLagMonitor, ParseOffloader
+from weibo_scraper_tracing import Tracer, trace_span
+from weibo_scraper_metrics import FETCH_SECONDS, PROXY_REQUESTS, HEDGES, ERRORS, USERS, ROWS, SEEN_SKIPPED, WRITE_SECONDS, QUEUE_DEPTH, \
+    start_metrics_server, metrics_reporter
 
 
-_WEIBO_DATE_FORMAT = "%a %b %d %H:%M:%S %z %Y"
-_HREF_PATTERN = r'<a\s+href="([^"]+)">全文<\/a>$'
+_HREF_PATTERN = re.compile(r'<a\s+href="([^"]+)">全文<\/a>$')
 _DETAIL_PAGE_PATTERN = re.compile(r'var \$render_data = \[(.*?)\]\[0\] \|\| \{\};', re.DOTALL)
-_CHECKED_PROXY_QUEUE = asyncio.Queue()
+_RATE_LIMITER = AdaptiveRateLimiter()
+_PROXY_REGISTRY = ProxyRegistry(on_remove=_RATE_LIMITER.forget)
+_STATE_STORE = None
+_SEEN_IDS = None
+_SHARED_CONNECTOR = None
+_PROXY_SEMAPHORES = {}
+_HEDGE_POLICY = HedgePolicy()
 _UNCHECKED_PROXY_QUEUE = asyncio.Queue()
-_CHECK_URL = "https://m.weibo.cn/"
+_PROXY_CHECK_SEMAPHORE = asyncio.Semaphore(PROXY_CHECKER_COUNT)
+_IDENTITY_POOL = IdentityPool(IDENTITY_POOL_SIZE)
+_LAG_MONITOR = None
+_OFFLOADER = None
+_TRACER = Tracer()
+_RUNNING_ENGINE = None
+# the engine the module globals belong to, from its start to the end of its stop
 _MOBILE_HEADERS = {
     "accept": "application/json, text/plain, */*",
     "accept-language": "en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7,ja;q=0.6,hy;q=0.5",
@@ -30,150 +53,318 @@ _MOBILE_HEADERS = {
     "Referer": "https://m.weibo.cn/u/5428731890?tabtype=album&jumpfrom=weibocom",
     "Referrer-Policy": "strict-origin-when-cross-origin"
 }
+ParsedCard = collections.namedtuple("ParsedCard", ["url_id", "is_top", "timestamp", "detail_href", "data_line"])
+HighWaterMark = collections.namedtuple("HighWaterMark", ["uid", "url_id", "timestamp"])
+# put to the results queue after the rows of a completed walk, the writer saves it once the rows are written
+# what the walk needs of a card of a timeline page, see parse_timeline_page
 
-proxy_checker_count = None
+def get_shared_connector():
+    global _SHARED_CONNECTOR, CONNECTION_LIMIT, CONNECTION_LIMIT_PER_PROXY, KEEPALIVE_TIMEOUT, DNS_CACHE_TTL
+    """
+    DESCRIPTION:
+        returns the connection pool shared by all sessions, it is created on first use.
+        aiohttp keys pooled connections by host and proxy, so the pool keeps a set of keep-alive
+        connections per proxy, and CONNECTION_LIMIT_PER_PROXY caps each of them.
+        Sessions using it must be created with connector_owner=False, so closing a session keeps the pool open.
+    """
+    if _SHARED_CONNECTOR is None or _SHARED_CONNECTOR.closed:
+        _SHARED_CONNECTOR = aiohttp.TCPConnector(ssl=False,
+                                                 limit=CONNECTION_LIMIT,
+                                                 limit_per_host=CONNECTION_LIMIT_PER_PROXY,
+                                                 keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                                 use_dns_cache=True,
+                                                 ttl_dns_cache=DNS_CACHE_TTL)
+    return _SHARED_CONNECTOR
+
+
+def load_proxy_cache():
+    global _PROXY_REGISTRY, PROXY_CACHE_FILE, PROXY_CACHE_MAX_AGE
+    """
+    DESCRIPTION:
+        put the proxies saved by the previous run to the _PROXY_REGISTRY, unless the cache is older than PROXY_CACHE_MAX_AGE
+
+    OUTPUT:
+        the addresses that have been loaded
+    """
+    if not PROXY_CACHE_FILE or not os.path.exists(PROXY_CACHE_FILE):
+        return []
+    try:
+        with open(PROXY_CACHE_FILE, 'rb') as file:
+            cache = orjson.loads(file.read())
+        if time.time() - cache["saved_at"] > PROXY_CACHE_MAX_AGE:
+            return []
+        return _PROXY_REGISTRY.load(cache["proxies"])
+    except (OSError, KeyError, TypeError, orjson.JSONDecodeError):
+        return []
+
+
+def save_proxy_cache():
+    global _PROXY_REGISTRY, PROXY_CACHE_FILE
+    """
+    DESCRIPTION:
+        save the known proxies and their health records for the next run.
+        The cache is written to a temporary file first, so a crash does not leave a broken cache.
+    """
+    if not PROXY_CACHE_FILE or not len(_PROXY_REGISTRY):
+        return
+    temporary_file = PROXY_CACHE_FILE + ".tmp"
+    with open(temporary_file, 'wb') as file:
+        file.write(orjson.dumps({"saved_at": time.time(), "proxies": _PROXY_REGISTRY.dump()}))
+    os.replace(temporary_file, PROXY_CACHE_FILE)
+
+
+proxy_checks_in_progress = 0
 async def proxy_boss():
-    global _CHECKED_PROXY_QUEUE, _UNCHECKED_PROXY_QUEUE, GET_PROXY_FUNCTIONS, FORCE_RELEASE_LIMIT, PROXY_LOG_NAME, WORKER_SIZE, MAXIMUM_PROXY_WORKER_COUNT, workers_still_working, proxy_checker_count
+    global _PROXY_REGISTRY, _UNCHECKED_PROXY_QUEUE, GET_PROXY_FUNCTIONS, FORCE_RELEASE_LIMIT, PROXY_LOG_NAME, PROXY_CHECKER_COUNT, proxy_checks_in_progress
     """
     Description:
         This function is responsible for arranging everying concerning proxies, including:
-            1. load unchecked proxies by running all the functions in proxy_getter_set
-            2. assemble proxy checkers to check these uncheck proxies and ask them to put proxies to the CHECKED_PROXY_QUEUE
+            1. load the proxies saved by the previous run, so the workers can start right away.
+               They are re-validated by the proxy revalidator first thing.
+            2. start PROXY_CHECKER_COUNT proxy checkers and the proxy revalidator, who work until he gets off work
+            3. load unchecked proxies by running all the functions in GET_PROXY_FUNCTIONS at the same time and put them to the unchecked queue
+               whenever the _PROXY_REGISTRY runs low, so the checkers keep it topped up
+            4. save the known proxies for the next run when he gets off work
 
     Life Cycle:
-        Proxy boss is gathered by the main boss.
-        He will get off work when all the mweibo workers has finished their jobs.
+        Proxy boss is started by the scraper engine, and works for all of its crawl jobs.
+        He will get off work when the engine stops and cancels him.
     """
 
     # record the data that has already been put to the unchecked queue
-    previous_proxy_set = set() 
+    previous_proxy_set = set(load_proxy_cache())
     force_release = 0
+    await append_new_line_to_log(f"loaded {len(previous_proxy_set)} proxies from the proxy cache", PROXY_LOG_NAME)
     
-    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), connector=aiohttp.TCPConnector(ssl=False)) as proxy_boss_session:
-        while workers_still_working:
-            if _CHECKED_PROXY_QUEUE.qsize() > 10:
-                await asyncio.sleep(10)
-                continue
-            
-            # load proxy set
-            new_proxy_set = set()
-            
-            for function in GET_PROXY_FUNCTIONS:
-                new_proxy_list = await function(proxy_boss_session)
-                await append_new_line_to_log(f"{function.__name__}: return {len(new_proxy_list)} proxies", PROXY_LOG_NAME)
-                new_proxy_set.update(new_proxy_list)
-
-            await append_new_line_to_log(f"returned {len(new_proxy_set)} proxies in all", PROXY_LOG_NAME)
-            # delete the old items in new_proxy_set and add new items to previous_proxy_set
-            new_proxy_set.difference_update(previous_proxy_set)
-            previous_proxy_set.update(new_proxy_set)
-
-            # if there are no new proxies, wait 60s to retry
-            new_workers_count = len(new_proxy_set)
-            if new_workers_count < 3:
-                await append_new_line_to_log(f"No new items. Sleep before force release: {FORCE_RELEASE_LIMIT - force_release}", PROXY_LOG_NAME)
-                # if there are any proxy workers present, then stop panicking and rest unless the sleep time has reached FORCE_RELEASE_LIMIT, 
-                # in which case will release all the previous proxies for checking
-                if not proxy_checker_count:
-                    if force_release < FORCE_RELEASE_LIMIT:
-                        force_release += 1
-                        await asyncio.sleep(60)
+    # checks go through the shared pool, so a proxy that passes leaves a warm connection for the workers
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), connector=get_shared_connector(), connector_owner=False) as proxy_boss_session:
+        await append_new_line_to_log(f"starting {PROXY_CHECKER_COUNT} proxy checkers", PROXY_LOG_NAME)
+        proxy_checkers = [asyncio.create_task(proxy_checker(proxy_boss_session)) for _ in range(PROXY_CHECKER_COUNT)]
+        revalidator = asyncio.create_task(proxy_revalidator(proxy_boss_session))
+        try:
+            while True:
+                # the registry is topped up, or the checkers still have enough to check
+                if _PROXY_REGISTRY.qsize() > 10 or _UNCHECKED_PROXY_QUEUE.qsize() > PROXY_CHECKER_COUNT:
+                    await asyncio.sleep(10)
+                    continue
+                
+                # load proxy set from all the sources at the same time
+                new_proxy_set = set()
+                proxy_functions = list(GET_PROXY_FUNCTIONS)
+                new_proxy_lists = await asyncio.gather(*[function(proxy_boss_session) for function in proxy_functions],
+                                                       return_exceptions=True)
+                for function, new_proxy_list in zip(proxy_functions, new_proxy_lists):
+                    if isinstance(new_proxy_list, Exception):
+                        await append_new_line_to_log(f"{function.__name__}: failed {type(new_proxy_list)} {new_proxy_list}", PROXY_LOG_NAME,
+                                                     LOG_WARNING, rate_limit_key=f"proxy source failed {function.__name__}")
                         continue
+                    await append_new_line_to_log(f"{function.__name__}: return {len(new_proxy_list)} proxies", PROXY_LOG_NAME)
+                    new_proxy_set.update(new_proxy_list)
+
+                await append_new_line_to_log(f"returned {len(new_proxy_set)} proxies in all", PROXY_LOG_NAME)
+                # delete the old items in new_proxy_set and add new items to previous_proxy_set
+                new_proxy_set.difference_update(previous_proxy_set)
+                previous_proxy_set.update(new_proxy_set)
+
+                # if there are no new proxies, wait 60s to retry
+                if len(new_proxy_set) < 3:
+                    await append_new_line_to_log(f"No new items. Sleep before force release: {FORCE_RELEASE_LIMIT - force_release}", PROXY_LOG_NAME)
+                    # if the checkers are still checking, then stop panicking and rest unless the sleep time has reached FORCE_RELEASE_LIMIT, 
+                    # in which case will release all the previous proxies for checking
+                    if _UNCHECKED_PROXY_QUEUE.empty() and not proxy_checks_in_progress:
+                        if force_release < FORCE_RELEASE_LIMIT:
+                            force_release += 1
+                            await asyncio.sleep(60)
+                            continue
+                        else:
+                            await append_new_line_to_log("Releasing old ones", PROXY_LOG_NAME)
+                            # proxies that are still in the registry have a health record already
+                            new_proxy_set = {addr for addr in previous_proxy_set if addr not in _PROXY_REGISTRY}
                     else:
-                        await append_new_line_to_log("Releasing old ones", PROXY_LOG_NAME)
-                        new_proxy_set = previous_proxy_set
-                        new_workers_count = len(previous_proxy_set)
-                else:
+                        await asyncio.sleep(5)
+                        continue
+
+                force_release = 0
+                await append_new_line_to_log(f"queueing {len(new_proxy_set)} proxies for the checkers", PROXY_LOG_NAME)
+                for addr in new_proxy_set:
+                    _UNCHECKED_PROXY_QUEUE.put_nowait((addr, 0))
+                if not new_proxy_set:
                     await asyncio.sleep(5)
+        finally:
+            for task in proxy_checkers + [revalidator]:
+                task.cancel()
+            await asyncio.gather(*proxy_checkers, revalidator, return_exceptions=True)
+            save_proxy_cache()
+
+
+async def proxy_broker_client():
+    global _PROXY_REGISTRY, PROXY_BROKER_URL, PROXY_BROKER_BATCH, PROXY_BROKER_LEASE_TTL, PROXY_LOG_NAME
+    """
+    Description:
+        This function takes the place of proxy boss when the scraper runs as a shard of weibo_scraper_launcher.
+        The proxies are checked once by the proxy broker process for all the shards,
+        and this function asks the broker for PROXY_BROKER_BATCH checked proxies whenever the registry runs low.
+        The broker hands every proxy to one shard only, and at most a fair share of them to each shard.
+        Every third of PROXY_BROKER_LEASE_TTL the leases of the proxies still in the registry are renewed,
+        and the evicted ones are given back, so the broker checks them again and hands them out to the shards again.
+
+    Life Cycle:
+        Proxy broker client is started by the scraper engine instead of proxy boss.
+        He will get off work when the engine stops and cancels him, and gives all his proxies back then.
+    """
+    broker_proxies = set()
+    renew_time = time.monotonic() + PROXY_BROKER_LEASE_TTL / 3
+    async with aiohttp.ClientSession() as broker_session:
+        try:
+            while True:
+                if time.monotonic() >= renew_time:
+                    held = {addr for addr in broker_proxies if addr in _PROXY_REGISTRY}
+                    if await update_broker_leases(broker_session, held, broker_proxies - held):
+                        broker_proxies = held
+                    renew_time = time.monotonic() + PROXY_BROKER_LEASE_TTL / 3
+
+                if _PROXY_REGISTRY.qsize() > 10:
+                    await asyncio.sleep(1)
                     continue
-                
 
-            force_release = 0
-            
-            if proxy_checker_count == None:
-                proxy_checker_count = 0
-
-            if new_workers_count + proxy_checker_count > MAXIMUM_PROXY_WORKER_COUNT:
-                new_workers_count = MAXIMUM_PROXY_WORKER_COUNT - proxy_checker_count
-                proxy_checker_count = MAXIMUM_PROXY_WORKER_COUNT
-            else:
-                proxy_checker_count += new_workers_count
-            
-            
+                try:
+                    params = {"count": PROXY_BROKER_BATCH, "have": len(_PROXY_REGISTRY)}
+                    async with broker_session.get(f"{PROXY_BROKER_URL}/proxies", params=params) as resp:
+                        proxies = orjson.loads(await resp.read())
+                except (aiohttp.ClientError, orjson.JSONDecodeError) as e:
+                    await append_new_line_to_log(f"proxy broker failed: {type(e)} {e}", PROXY_LOG_NAME, LOG_WARNING,
+                                                 rate_limit_key="proxy broker failed")
+                    proxies = []
 
-            # gather workers
-            await append_new_line_to_log(f"gathering {new_workers_count} new workers, {proxy_checker_count} in all", PROXY_LOG_NAME)
-            proxy_checkers = []
-            for _ in range(new_workers_count):
-                proxy_checkers.append(asyncio.create_task(proxy_checker(proxy_boss_session)))
-            
-            for addr in new_proxy_set:
-                await _UNCHECKED_PROXY_QUEUE.put((addr, 0))
-            
-            await asyncio.gather(*proxy_checkers)
-    
+                for addr, latency in proxies:
+                    _PROXY_REGISTRY.put(addr, latency)
+                    broker_proxies.add(addr)
+                if proxies:
+                    await append_new_line_to_log(f"proxy broker: return {len(proxies)} proxies", PROXY_LOG_NAME, LOG_DEBUG)
+                else:
+                    await asyncio.sleep(1)
+        finally:
+            await update_broker_leases(broker_session, set(), broker_proxies)
+
+
+async def update_broker_leases(broker_session: aiohttp.ClientSession, held, released):
+    global PROXY_BROKER_URL, PROXY_LOG_NAME
+    """
+    DESCRIPTION:
+        renew the broker leases of the held proxies and give the released ones back
+
+    OUTPUT:
+        True if the broker got the update
+    """
+    try:
+        body = orjson.dumps({"held": list(held), "released": list(released)})
+        async with broker_session.post(f"{PROXY_BROKER_URL}/leases", data=body, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            resp.raise_for_status()
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await append_new_line_to_log(f"proxy broker lease update failed: {type(e)} {e}", PROXY_LOG_NAME, LOG_WARNING,
+                                     rate_limit_key="proxy broker lease update failed")
+        return False
+
+
+async def check_proxy(session: aiohttp.ClientSession, addr):
+    global _PROXY_CHECK_SEMAPHORE, PROXY_TIMEOUT, MWEIBO_BASE_URL, PROXY_LOG_NAME, proxy_checks_in_progress
+    """
+    DESCRIPTION:
+        check if the proxy can reach the mobile weibo index with a HEAD request, so only the status and headers are sent.
+        At most PROXY_CHECKER_COUNT checks run at once, new proxies and re-validations together.
+
+    OUTPUT:
+        the response time in seconds, or None if the check failed
+    """
+    async with _PROXY_CHECK_SEMAPHORE:
+        proxy_checks_in_progress += 1
+        try:
+            start_time = time.monotonic()
+            async with session.head(f"{MWEIBO_BASE_URL}/", proxy=addr, timeout=PROXY_TIMEOUT, allow_redirects=False) as resp:
+                status_code = resp.status
+            latency = time.monotonic() - start_time
+            if status_code >= 400:
+                raise aiohttp.ClientError(f"status {status_code}")
+            await append_new_line_to_log(f">>>>>>{addr} responded {status_code} in {latency:.2f}s", PROXY_LOG_NAME, LOG_DEBUG)
+            return latency
+        except (aiohttp.ClientError, TimeoutError) as e:
+            await append_new_line_to_log(f"{addr} proxy check failed: {type(e)} {e}", PROXY_LOG_NAME, LOG_DEBUG)
+            return None
+        finally:
+            proxy_checks_in_progress -= 1
 
 
 async def proxy_checker(session: aiohttp.ClientSession):
-    global _CHECKED_PROXY_QUEUE, _UNCHECKED_PROXY_QUEUE, PROXY_TIMEOUT, PROXY_RETRY, _CHECK_URL, PROXY_LOG_NAME, proxy_checker_count
+    global _PROXY_REGISTRY, _UNCHECKED_PROXY_QUEUE, PROXY_RETRY, PROXY_LOG_NAME
     """
     Description:
         This function is proxy boss' worker who 
             1. get unchecked proxy and the checked count from _UNCHECKED_PROXY_QUEUE, 
             2. check the proxy if the checked count did nor reach maximum retry, and
-            3. put the valid ones to the CHECKED_PROXY_QUEUE and the invalid ones back to the unchecked proxy queue with checked count += 1
+            3. put the valid ones with their response time to the _PROXY_REGISTRY and the invalid ones back to the unchecked proxy queue with checked count += 1
 
     Life Cycle:
-        Proxy checkers are gathered by proxy boss.
-        They will get off work when the queue is empty.
+        Proxy checkers are started by proxy boss and wait for the unchecked queue to be fed.
+        They are cancelled when proxy boss gets off work.
     """
 
-    while workers_still_working and not _UNCHECKED_PROXY_QUEUE.empty():
-        
-        # if already has failed checking for $PROXY_RETRY times, the worker will get a new one
-        while not _UNCHECKED_PROXY_QUEUE.empty():
-            addr, check_count = await _UNCHECKED_PROXY_QUEUE.get()
-            if check_count < PROXY_RETRY:
-                break
-        if check_count > PROXY_RETRY - 1 and _UNCHECKED_PROXY_QUEUE.empty():
-            break
+    while True:
+        addr, check_count = await _UNCHECKED_PROXY_QUEUE.get()
+        # if already has failed checking for $PROXY_RETRY times, the checker drops it
+        if check_count >= PROXY_RETRY:
+            continue
 
-        # try to check if the proxy is reachable by connecting to _CHECK_URL
-        try:
-            async with session.get(_CHECK_URL, proxy=addr, timeout=PROXY_TIMEOUT) as resp:
-                status_code = resp.status
-                if status_code != 200:
-                    raise aiohttp.ClientError()
-                await append_new_line_to_log(f">>>>>>{addr} responded {status_code}", PROXY_LOG_NAME)
-                await append_new_line_to_log(f"avalible proxy: {_CHECKED_PROXY_QUEUE.qsize()}", PROXY_LOG_NAME)
-                await _CHECKED_PROXY_QUEUE.put(addr)
+        latency = await check_proxy(session, addr)
+        if latency is not None:
+            _PROXY_REGISTRY.put(addr, latency)
+        else:
+            await append_new_line_to_log(f"{addr} retry remaining {PROXY_RETRY - check_count - 1}", PROXY_LOG_NAME, LOG_DEBUG)
+            _UNCHECKED_PROXY_QUEUE.put_nowait((addr, check_count + 1))
+        await append_new_line_to_log(f"avalible proxy: {_PROXY_REGISTRY.qsize()}", PROXY_LOG_NAME, LOG_DEBUG)
 
-        # put back to the queue
-        except (aiohttp.ClientError, TimeoutError) as e:
-            await append_new_line_to_log(f"{addr} proxy check failed: {type(e)} {e}, retry remaining {PROXY_RETRY - check_count}", PROXY_LOG_NAME)
-            await append_new_line_to_log(f"avalible proxy: {_CHECKED_PROXY_QUEUE.qsize()}", PROXY_LOG_NAME)
-            check_count += 1
-            await _UNCHECKED_PROXY_QUEUE.put((addr, check_count))
-    
-    proxy_checker_count -= 1
-    await append_new_line_to_log(f"proxy checker get off work. remaining {proxy_checker_count}", PROXY_LOG_NAME)
-        
 
-            
+async def proxy_revalidator(session: aiohttp.ClientSession):
+    global _PROXY_REGISTRY, PROXY_REVALIDATE_INTERVAL, PROXY_LOG_NAME
+    """
+    Description:
+        This function checks the idle proxies in the _PROXY_REGISTRY again when they have not been checked
+        or used successfully for PROXY_REVALIDATE_INTERVAL seconds, so a proxy that died while it was idle
+        is benched before a worker leases it.
+        The proxies loaded from the proxy cache count as not seen, so they are re-validated when he starts.
 
+    Life Cycle:
+        Proxy revalidator is started by proxy boss and cancelled when proxy boss gets off work.
+    """
+    while True:
+        stale_proxies = _PROXY_REGISTRY.stale_idle_proxies(PROXY_REVALIDATE_INTERVAL)
+        if stale_proxies:
+            await append_new_line_to_log(f"re-validating {len(stale_proxies)} idle proxies", PROXY_LOG_NAME, LOG_DEBUG)
+            latencies = await asyncio.gather(*[check_proxy(session, addr) for addr in stale_proxies])
+            for addr, latency in zip(stale_proxies, latencies):
+                _PROXY_REGISTRY.report_check(addr, latency)
+        await asyncio.sleep(PROXY_REVALIDATE_INTERVAL)
 
-async def proxy_fetcher(session: aiohttp.ClientSession, url, retry=FETCHER_RETRY, proxy=None, **kwargs):
-    global _CHECKED_PROXY_QUEUE, _UNCHECKED_PROXY_QUEUE, PROXY_TIMEOUT
+
+async def proxy_fetcher(session: aiohttp.ClientSession, url, retry=FETCHER_RETRY, proxy=None, endpoint="other", shared=False, **kwargs):
+    global _PROXY_REGISTRY, PROXY_LOG_NAME
     """
     Description:
         This function is the worker who handles all the internet connections.
-        fetcher will get a proxy from CHECKED_PROXY_QUEUE if proxy=True
+        fetcher will lease the best scored proxy from _PROXY_REGISTRY if proxy is not given
         if proxy failed, it will retry
         the kwargs will be passed to session.get()
         It will return the raw text of the requested html.
+        Every response time and failure is reported to _PROXY_REGISTRY.
+        Requests are paced by _RATE_LIMITER, and non-200 responses slow the proxy down.
+        The response time is recorded in the metrics under endpoint, eg. "timeline page".
+        A slow request is hedged through a second proxy, see hedged_fetch.
 
     Error handling:
-        Upon error, fetcher will put the proxy back to unchecked queue with checked count = 1
+        Upon error, fetcher will report the failure and release the proxy, 
+        the registry decides whether it goes back to idle, cools down or gets evicted.
+        If shared, the given proxy is in use by other fetches at the same time, eg. the detail pages of a page,
+        and it is not released, the caller releases it once they are done. The proxies leased for the retries are the fetcher's
     
     Life Cycle:
         Fetchers are called upon use and exit upon return
@@ -182,163 +373,632 @@ async def proxy_fetcher(session: aiohttp.ClientSession, url, retry=FETCHER_RETRY
     # if retry has excceded limit, return
     if retry < 1:
         return None, proxy
-    try:
     # If a proxy is not given or None/False, get a proxy from checked queue. 
-        if proxy:
-            proxy_addr = proxy
-        else:
-            proxy_addr = await _CHECKED_PROXY_QUEUE.get()
-        
-        async with session.get(url, proxy=proxy_addr, timeout=PROXY_TIMEOUT, **kwargs) as resp:
-            response_text = await resp.text(encoding='utf8')
-            return response_text, proxy_addr
+    if proxy:
+        proxy_addr = proxy
+    else:
+        with trace_span("proxy wait", endpoint=endpoint):
+            proxy_addr = await _PROXY_REGISTRY.get()
+    try:
+        with trace_span("fetch", endpoint=endpoint, proxy=proxy_addr, retry=FETCHER_RETRY - retry):
+            return await hedged_fetch(session, url, proxy_addr, endpoint, shared=shared, **kwargs)
         
-    # if the connection throws an error, put it back to the unchecked queue
+    # if the connection throws an error, give the proxy back to the registry and switch to another one
     except (aiohttp.ClientError, TimeoutError) as e:
-        await append_new_line_to_log(f"{proxy_addr} connection failed to connect {url}, retry remaining {retry}):{e}", PROXY_LOG_NAME)
-        await append_new_line_to_log(f"avalible proxy: {_CHECKED_PROXY_QUEUE.qsize()}", PROXY_LOG_NAME)
+        await append_new_line_to_log(f"{proxy_addr} connection failed to connect {url}, retry remaining {retry}):{e}", PROXY_LOG_NAME,
+                                     LOG_WARNING, rate_limit_key=f"fetch failed {type(e).__name__}")
+        await append_new_line_to_log(f"avalible proxy: {_PROXY_REGISTRY.qsize()}", PROXY_LOG_NAME, LOG_DEBUG)
         retry -= 1
-        await _UNCHECKED_PROXY_QUEUE.put((proxy_addr, 999))
-        return await proxy_fetcher(session, url, retry=retry, proxy=None, **kwargs)
+        if not shared:
+            _PROXY_REGISTRY.release(proxy_addr)
+        return await proxy_fetcher(session, url, retry=retry, proxy=None, endpoint=endpoint, **kwargs)
+
+
+async def hedged_fetch(session: aiohttp.ClientSession, url, proxy_addr, endpoint, shared=False, **kwargs):
+    global _PROXY_REGISTRY, _RATE_LIMITER, _HEDGE_POLICY
+    """
+    DESCRIPTION:
+        get url through proxy_addr, paced by the rate limiter. If it has not answered after the hedge delay of the endpoint and the hedge budget allows,
+        the same request is sent through an idle proxy as well, the first good answer is taken and the other request is cancelled.
+        If the hedge wins, the caller switches to the hedge proxy, and the slow proxy is given back to the registry,
+        unless it is shared, see proxy_fetcher.
+
+    OUTPUT:
+        the response text, the proxy the caller should use next
+
+    Error handling:
+        if the request through proxy_addr fails and the hedge, if any, fails too, the error of proxy_addr is raised
+        and proxy_addr is still the caller's to release. The hedge proxy is released here unless it is handed to the caller,
+        also when the caller is cancelled
+    """
+    # waiting for the rate limiter is not slowness of the proxy
+    with trace_span("rate limit wait", proxy=proxy_addr):
+        await _RATE_LIMITER.acquire(proxy_addr)
+    start_time = time.monotonic()
+    primary = asyncio.create_task(fetch_through_proxy(session, url, proxy_addr, endpoint, **kwargs))
+    hedge = None
+    hedge_addr = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=_HEDGE_POLICY.delay(endpoint))
+        if not done and _HEDGE_POLICY.try_spend():
+            hedge_addr = _PROXY_REGISTRY.get_nowait()
+            if not hedge_addr:
+                _HEDGE_POLICY.refund()
+        if not hedge_addr:
+            return await primary, proxy_addr
+
+        with trace_span("hedge", endpoint=endpoint, proxy=hedge_addr) as span:
+            with trace_span("rate limit wait", proxy=hedge_addr):
+                await _RATE_LIMITER.acquire(hedge_addr)
+            hedge = asyncio.create_task(fetch_through_proxy(session, url, hedge_addr, endpoint, **kwargs))
+            pending = {primary, hedge}
+            winner = None
+            # a failed request does not win, the other one is waited for
+            while pending and not winner:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+            span.set(result="won" if winner is hedge else "lost")
+        if winner is hedge:
+            HEDGES.inc(endpoint, "won")
+            if not primary.done():
+                _PROXY_REGISTRY.report_slow(proxy_addr, time.monotonic() - start_time)
+            if not shared:
+                _PROXY_REGISTRY.release(proxy_addr)
+            winner_addr, hedge_addr = hedge_addr, None
+            return hedge.result(), winner_addr
+        HEDGES.inc(endpoint, "lost")
+        return await primary, proxy_addr
+    finally:
+        for task in (primary, hedge):
+            if task and not task.done():
+                task.cancel()
+        if hedge_addr:
+            _PROXY_REGISTRY.release(hedge_addr)
+
+
+async def fetch_through_proxy(session: aiohttp.ClientSession, url, proxy_addr, endpoint, **kwargs):
+    global _PROXY_REGISTRY, _RATE_LIMITER, _HEDGE_POLICY, PROXY_TIMEOUT
+    """
+    DESCRIPTION:
+        one request through one proxy, the caller has waited for the rate limiter. The response time and the result are reported
+        to the registry, the hedge policy and the metrics.
+
+    OUTPUT:
+        the response text
+
+    Error handling:
+        connection errors and timeouts are reported as a failure of the proxy and raised
+    """
+    start_time = time.monotonic()
+    try:
+        with trace_span("request", endpoint=endpoint, proxy=proxy_addr) as span:
+            async with session.get(url, proxy=proxy_addr, timeout=PROXY_TIMEOUT, **kwargs) as resp:
+                response_text = await resp.text(encoding='utf8')
+                span.set(status=resp.status)
+                if resp.status != 200:
+                    _RATE_LIMITER.report_throttled(proxy_addr)
+                    PROXY_REQUESTS.inc(proxy_addr, f"http_{resp.status}")
+                else:
+                    PROXY_REQUESTS.inc(proxy_addr, "ok")
+    except (aiohttp.ClientError, TimeoutError) as e:
+        FETCH_SECONDS.observe(time.monotonic() - start_time, endpoint)
+        PROXY_REQUESTS.inc(proxy_addr, type(e).__name__)
+        _PROXY_REGISTRY.report_failure(proxy_addr)
+        raise
+    latency = time.monotonic() - start_time
+    FETCH_SECONDS.observe(latency, endpoint)
+    _PROXY_REGISTRY.report_success(proxy_addr, latency)
+    _HEDGE_POLICY.observe(endpoint, latency)
+    return response_text
+
+
+async def identity_warmer():
+    global _PROXY_REGISTRY, _IDENTITY_POOL, _MOBILE_HEADERS, MWEIBO_BASE_URL
+    """
+    Description:
+        This function warms up session identities for the workers: it leases a proxy, 
+        visits https://m.weibo.cn/ through it with a new cookie jar to get the cookies, 
+        and puts the identity to the identity pool. He waits while the pool is full.
+
+    Life Cycle:
+        identity warmers are started by the scraper engine and cancelled when it stops.
+    """
+    while True:
+        # the cookies are private to the identity, the connections are shared with everyone
+        session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), connector=get_shared_connector(), connector_owner=False)
+        try:
+            response_text, proxy = await proxy_fetcher(session, f"{MWEIBO_BASE_URL}/", endpoint="warm up", headers=_MOBILE_HEADERS)
+            if response_text is not None:
+                await _IDENTITY_POOL.put(SessionIdentity(session, proxy))
+                continue
+        except asyncio.CancelledError:
+            await session.close()
+            raise
+        await session.close()
+        if proxy:
+            _PROXY_REGISTRY.release(proxy)
 
 
-workers_still_working = WORKER_SIZE
-async def mweibo_worker(id_queue: asyncio.Queue, results_queue: asyncio.Queue):
-    global _CHECKED_PROXY_QUEUE, _MOBILE_HEADERS, uid_assigner_work_done, workers_still_working
+async def mweibo_worker(job):
+    global _PROXY_REGISTRY, _RATE_LIMITER, _MOBILE_HEADERS, _STATE_STORE, _IDENTITY_POOL, USER_INDEX_TTL, IDENTITY_MAX_USES
     """
     Description:
         This function will 
-            1. create a session with cookie
-            2. fetch cookie from https://m.weibo.cn/u/${user_id} in order to get fid in cookie
-            3. fetch json from https://m.weibo.cn/api/container/getIndex?type=uid&value=${user_id} in order to get fid for weibo messeges container
-            4. fetch json from https://m.weibo.cn/api/container/getIndex?type=uid&value=${user_id} to get pages of weibo
+            1. check out a session identity with cookie from the identity pool, and use its proxy
+            2. fetch json from https://m.weibo.cn/api/container/getIndex?type=uid&value=${user_id} in order to get fid for weibo messeges container
+            3. fetch json from https://m.weibo.cn/api/container/getIndex?type=uid&value=${user_id} to get pages of weibo
+        The identity is kept for the next users, and retired after IDENTITY_MAX_USES users,
+        or when its proxy was throttled or replaced while scraping a user.
+        The fid and post count of step 2 are kept in the state store for USER_INDEX_TTL seconds,
+        and a user whose fid is known skips step 2. If the walk with a known fid breaks, the fid is forgotten,
+        so the next attempt looks it up again.
+        If the job has a job table, a JobResult is put to the results queue after the pages of the user,
+        so the writer marks the user done or failed once the rows are written.
     
     Life Cycle:
-        mweibo workers are gathered by the main boss.
-        They get off work when they receive the None sign from assigner
+        mweibo workers are started by their crawl job.
+        They get off work when they receive the None sign from assigner, or when the job is cancelled.
+        The last one to get off work sends the False sign to the writer.
     """
 
     # the worker should have a consistent proxy unless the proxy is broken. 
-    # Though this should be initialized in the first fetch
+    # It comes with the identity
     private_proxy = None
+    identity = None
 
-    while True:
-        # if the worker receives the message for taking off, he takes off
-        user_id = await id_queue.get()
-        if not user_id:
-            break
+    try:
+        while True:
+            # if the worker receives the message for taking off, he takes off
+            user_id = await job.id_queue.get()
+            if not user_id:
+                break
 
-        m_weibo_index_page_url = f"https://m.weibo.cn/u/{user_id}"
-        m_weibo_index_json_url = f"https://m.weibo.cn/api/container/getIndex?type=uid&value={user_id}"
+            # the spans of the user go to its trace, if the tracer picks it
+            with _TRACER.user(user_id) as user_span:
+                m_weibo_index_json_url = f"{MWEIBO_BASE_URL}/api/container/getIndex?type=uid&value={user_id}"
 
-        # the worker should have a private session cookie
-        async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), connector=aiohttp.TCPConnector(ssl=False)) as session:
+                # the identity has a private session cookie, but the connections are shared with other users
+                if identity is None:
+                    with trace_span("identity checkout"):
+                        identity = await _IDENTITY_POOL.checkout()
+                    private_proxy = identity.proxy
+                session = identity.session
+                throttle_count = _RATE_LIMITER.throttle_count(private_proxy)
+                m_weibo_index_data = None
+                m_weibo_index_json_text = None
+                job_error = None
+                user_index = _STATE_STORE.get_user_index(user_id, USER_INDEX_TTL) if USER_INDEX_TTL else None
+                # try to fetch the message data. If anything goes wrong with operating the json, finish this job
+                try:
+                    retry = 0 if user_index else FETCHER_RETRY
+                    while retry:
+                        m_weibo_index_json_text, private_proxy = await proxy_fetcher(session, m_weibo_index_json_url, proxy=private_proxy,
+                                                                                     endpoint="getIndex", headers=_MOBILE_HEADERS)
+                        m_weibo_index_json = orjson.loads(m_weibo_index_json_text)
+                        m_weibo_index_data = m_weibo_index_json["data"]
+                        if m_weibo_index_data.get('errmsg'):
+                            await append_new_line_to_log(f"errmsg:: {m_weibo_index_data.get('errmsg')}:: {m_weibo_index_data}", ERROR_LOG_NAME,
+                                                         LOG_WARNING, rate_limit_key="errmsg")
+                            ERRORS.inc("index", "errmsg")
+                            # the rate limiter makes the retry wait until the proxy has cooled down
+                            _RATE_LIMITER.report_throttled(private_proxy)
+                            retry -= 1
+                        else:
+                            _RATE_LIMITER.report_clean(private_proxy)
+                            break
             
-            m_weibo_index_data = None
-            # try to fetch the message data. If anything goes wrong with operating the json, finish this job
-            try:
-                retry = FETCHER_RETRY
-                while retry:
-                    # visit the index page to get cookie
-                    _, private_proxy = await proxy_fetcher(session, m_weibo_index_page_url,
-                                                        proxy=private_proxy, headers=_MOBILE_HEADERS)
-                    m_weibo_index_json_text, private_proxy = await proxy_fetcher(session, m_weibo_index_json_url,
-                                                                         proxy=private_proxy, headers=_MOBILE_HEADERS)
-                    m_weibo_index_json = orjson.loads(m_weibo_index_json_text)
-                    m_weibo_index_data = m_weibo_index_json["data"]
-                    if m_weibo_index_data.get('errmsg'):
-                        await append_new_line_to_log(f"errmsg:: {m_weibo_index_data.get('errmsg')}:: {m_weibo_index_data}", ERROR_LOG_NAME)
-                        await asyncio.sleep(10)
-                        retry -= 1
+                    if user_index:
+                        weibo_fid, post_count = user_index
                     else:
-                        break
-                
-                weibo_fid = m_weibo_index_data["tabsInfo"]["tabs"][1]["containerid"]
-                user_weibo_msgs_list, private_proxy = await fetch_weibo_messages(private_proxy, user_id, weibo_fid, session)
-                if user_weibo_msgs_list and len(user_weibo_msgs_list) > 0:
-                    await results_queue.put(user_weibo_msgs_list)
-            except (TypeError, KeyError, orjson.JSONDecodeError) as e:
-                await append_new_line_to_log(f"unknown error:: {type(e)}{e}:: {m_weibo_index_json_text}", ERROR_LOG_NAME)
-            finally:
-                await asyncio.sleep(random.random())
+                        weibo_fid = m_weibo_index_data["tabsInfo"]["tabs"][1]["containerid"]
+                        post_count = m_weibo_index_data.get("userInfo", {}).get("statuses_count")
+                        if USER_INDEX_TTL:
+                            _STATE_STORE.set_user_index(user_id, weibo_fid, post_count)
+                    _, private_proxy, completed = await fetch_weibo_messages(private_proxy, user_id, weibo_fid, session, job.results_queue,
+                                                                             post_count)
+                    if not completed:
+                        job_error = "timeline walk broken"
+                        if user_index:
+                            _STATE_STORE.delete_user_index(user_id)
+                except (TypeError, KeyError, orjson.JSONDecodeError) as e:
+                    await append_new_line_to_log(f"unknown error:: {type(e)}{e}:: {m_weibo_index_json_text}", ERROR_LOG_NAME,
+                                                 LOG_ERROR, rate_limit_key=f"index error {type(e).__name__}")
+                    ERRORS.inc("index", type(e).__name__)
+                    job_error = f"index {type(e).__name__}: {e}"
+                if job_error:
+                    user_span.set(error=job_error)
+                USERS.inc()
+                if job.job_table:
+                    await job.results_queue.put(JobResult(user_id, job_error))
 
-    workers_still_working -= 1
-    print(f"worker {workers_still_working} completed")
-    if not workers_still_working:
-        await results_queue.put(False)
-        print("all workers completed")
+            identity.uses += 1
+            if identity.uses >= IDENTITY_MAX_USES or private_proxy != identity.proxy or \
+                    _RATE_LIMITER.throttle_count(private_proxy) > throttle_count:
+                await identity.session.close()
+                identity = None
+                # the next identity comes with its own proxy
+                if private_proxy:
+                    _PROXY_REGISTRY.release(private_proxy)
+                private_proxy = None
+    finally:
+        if identity:
+            await identity.session.close()
+        # let other workers use the proxy after this worker gets off work
+        if private_proxy:
+            _PROXY_REGISTRY.release(private_proxy)
+        job.workers_still_working -= 1
+        print(f"worker {job.workers_still_working} completed")
+        if not job.workers_still_working:
+            # the writer only waits for a page while the results queue is empty
+            if job.results_queue.empty():
+                job.results_queue.put_nowait(False)
+            print("all workers completed")
 
 
-async def fetch_weibo_messages(private_proxy, user_id, fid, session):
-    global _MOBILE_HEADERS
+async def fetch_weibo_messages(private_proxy, user_id, fid, session, results_queue: asyncio.Queue, post_count=None):
+    global _PROXY_REGISTRY, _MOBILE_HEADERS, _STATE_STORE, _RATE_LIMITER, _SEEN_IDS, INCREMENTAL_CRAWL, PAGE_PARALLEL_COUNT, PAGE_PARALLEL_MIN_POSTS
+    """
+    Description:
+        This function walks the user's timeline page by page with since_id and puts the rows of every page 
+        to the results queue right away. The results queue is bounded, so the walk waits when the writer falls behind.
+        It returns the amount of rows, the proxy in use and whether the walk completed.
+        The detail pages of a page are fetched at the same time, at most DETAIL_CONCURRENCY_PER_USER at once.
+        If INCREMENTAL_CRAWL is on, the walk stops at the page that reaches the user's high water mark,
+        the newest weibo scraped in a previous run, and the weibos older than it are skipped.
+        When the walk completes, the newest weibo becomes the new high water mark. It is put to the results queue after the rows,
+        so the writer saves it only once the rows are written.
+        The weibos whose id has been written before, in this crawl or in a previous one with SEEN_ID_FILE,
+        are skipped without fetching their detail page, until the seen ids are full.
+
+        A user with at least PAGE_PARALLEL_MIN_POSTS posts and no high water mark is walked by page number instead,
+        up to PAGE_PARALLEL_COUNT pages at once through different proxies, and the detail pages of every page are fetched
+        through the proxy the page came through. The weibos are deduplicated by id, as a new weibo shifts the pages.
+        If a page is empty or newer than the page before it, the page numbers are not consistent,
+        and the walk goes on with since_id from the last consistent page.
+    """
 
     has_next = True
     since_id = None
-    all_lines = []
-    # sleep_determinator = 0
+    row_count = 0
+    high_water_mark = None
+    if INCREMENTAL_CRAWL:
+        high_water_mark = _STATE_STORE.get_high_water_mark(user_id)
+    newest_mark = high_water_mark
+    completed = True
+    user_semaphore = asyncio.Semaphore(DETAIL_CONCURRENCY_PER_USER)
+    user_info_url = f"{MWEIBO_BASE_URL}/api/container/getIndex?type=uid&value={user_id}&containerid={fid}"
+    page_number = None
+    # an incremental walk stops after a few pages at the mark, the pages fetched by number after it would be wasted
+    if PAGE_PARALLEL_COUNT > 1 and not high_water_mark and post_count and post_count >= PAGE_PARALLEL_MIN_POSTS:
+        page_number = 1
+    walk_url_ids = set()
+    oldest_timestamp = None
+    # pages are paced by the rate limiter in proxy_fetcher
     while has_next:
-        # sleep around 1s per page, and additional 1s more for every 5 page
-        await asyncio.sleep(0.2 + random.random())
-        # sleep_determinator += 1
-        # if sleep_determinator > 4:
-        #     await asyncio.sleep(0.5 + random.random())
-        #     sleep_determinator = 0
-                    
-        # the first page does not have since_id
-        user_info_url = f"https://m.weibo.cn/api/container/getIndex?type=uid&value={user_id}&containerid={fid}"
-        if since_id:
-            user_info_url = user_info_url + f"&since_id={since_id}"
-                    
-        weibo_messege_json_text, private_proxy = await proxy_fetcher(session, user_info_url, proxy=private_proxy, headers=_MOBILE_HEADERS)
-        try:
-            weibo_messege_json = orjson.loads(weibo_messege_json_text)
-            since_id = weibo_messege_json['data']['cardlistInfo'].get('since_id')
-            if not since_id:
+        if page_number:
+            page_results = await fetch_numbered_pages(private_proxy, session, user_info_url, page_number)
+            page_number += len(page_results)
+        else:
+            # the first page does not have since_id
+            page_url = user_info_url + f"&since_id={since_id}" if since_id else user_info_url
+            weibo_messege_json_text, private_proxy = await proxy_fetcher(session, page_url, proxy=private_proxy,
+                                                                         endpoint="timeline page", headers=_MOBILE_HEADERS)
+            page_results = [(weibo_messege_json_text, private_proxy)]
+
+        page_cards = []
+        for weibo_messege_json_text, page_proxy in page_results:
+            try:
+                page_since_id, parsed_cards = await parse_page(parse_timeline_page, weibo_messege_json_text)
+                # weibo answers a throttled request with an empty page
+                if parsed_cards:
+                    _RATE_LIMITER.report_clean(page_proxy)
+                else:
+                    _RATE_LIMITER.report_throttled(page_proxy)
+                    ERRORS.inc("timeline", "empty page")
+                cards = []
+                page_timestamps = []
+                # the ids of a page count as walked once the page is taken, a page that is not consistent is walked again
+                page_url_ids = set()
+                for card in parsed_cards:
+                    # cards that are not weibos have no url_id
+                    if card.url_id is not None:
+                        if not card.is_top:
+                            page_timestamps.append(card.timestamp or 0)
+                        if card.url_id in walk_url_ids or card.url_id in page_url_ids:
+                            continue
+                        page_url_ids.add(card.url_id)
+                        if high_water_mark and is_at_high_water_mark(card, high_water_mark):
+                            # pinned weibos can be older than the mark, but it does not mean the rest of the timeline is
+                            if not card.is_top:
+                                page_since_id = None
+                            continue
+                        if _SEEN_IDS is not None and not _SEEN_IDS.full and card.url_id in _SEEN_IDS:
+                            SEEN_SKIPPED.inc()
+                            continue
+                    cards.append(card)
+
+                if page_number and (not page_timestamps or oldest_timestamp is not None and max(page_timestamps) > oldest_timestamp):
+                    await append_new_line_to_log(f"page numbers of {user_id} are not consistent, walk on with since_id {since_id}",
+                                                 ERROR_LOG_NAME, LOG_WARNING, rate_limit_key="page numbers")
+                    ERRORS.inc("timeline", "page numbers")
+                    page_number = None
+                    break
+                if page_timestamps:
+                    oldest_timestamp = min(page_timestamps)
+                walk_url_ids.update(page_url_ids)
+                page_cards.append((cards, page_proxy))
+                since_id = page_since_id
+                # the pages fetched by number after the end of the timeline are not looked at
+                if not since_id:
+                    has_next = False
+                    break
+            except (TypeError, KeyError, AttributeError, orjson.JSONDecodeError) as e:
+                await append_new_line_to_log(f"{type(e)}{e}::{weibo_messege_json_text}", ERROR_LOG_NAME,
+                                             LOG_ERROR, rate_limit_key=f"timeline error {type(e).__name__}")
+                ERRORS.inc("timeline", type(e).__name__)
                 has_next = False
-            for card in weibo_messege_json["data"]["cards"]:
-                data_line, private_proxy = await check_if_has_detail(private_proxy, session, card)
-                if not data_line:
-                    if card.get("mblog"):
-                        data_line = get_row_from_mobile_data(card["mblog"])
-                    else:
-                        data_line = get_row_from_mobile_data(card)
-                if data_line:
-                    print(f"{data_line[0]}...ok")
-                    all_lines.append(data_line)
-        except (TypeError, KeyError, AttributeError, orjson.JSONDecodeError) as e:
-            await append_new_line_to_log(f"{type(e)}{e}::{weibo_messege_json_text}", ERROR_LOG_NAME)
-            has_next = False
-    return all_lines, private_proxy
-
-
-async def check_if_has_detail(private_proxy, session, card):
-    weibo_text = card["mblog"].get("text")
-    match = re.search(_HREF_PATTERN, weibo_text)
+                completed = False
+                break
+
+        # the pages of a round are turned into rows at the same time, and put to the results queue in page order
+        page_rows = await asyncio.gather(*[get_rows_from_cards(page_proxy, session, cards, user_semaphore)
+                                           for cards, page_proxy in page_cards])
+        used_proxies = [proxy for _, proxy in page_rows] + [proxy for _, proxy in page_results[len(page_rows):]]
+        for page_lines, _ in page_rows:
+            for data_line in page_lines:
+                if data_line[12] and (not newest_mark or data_line[12] > newest_mark[1]):
+                    newest_mark = (data_line[0], data_line[12])
+            if page_lines:
+                row_count += len(page_lines)
+                with trace_span("results queue wait", rows=len(page_lines)):
+                    await results_queue.put(page_lines)
+        # the first page went through the worker's proxy. The fetcher has released the proxies that failed,
+        # and the other proxies of the round are given back
+        private_proxy = used_proxies[0]
+        for proxy in set(used_proxies[1:]) - {private_proxy, None}:
+            _PROXY_REGISTRY.release(proxy)
+
+    # a broken walk leaves a gap below the newest weibo, so the mark only moves when the walk completes
+    if completed and newest_mark and newest_mark != high_water_mark:
+        await results_queue.put(HighWaterMark(user_id, *newest_mark))
+    return row_count, private_proxy, completed
+
+
+async def fetch_numbered_pages(private_proxy, session, user_info_url, first_page):
+    global _PROXY_REGISTRY, _MOBILE_HEADERS, PAGE_PARALLEL_COUNT
+    """
+    DESCRIPTION:
+        fetch up to PAGE_PARALLEL_COUNT timeline pages from first_page on at the same time. The first one goes through
+        the worker's proxy, the others through idle proxies leased from the registry, one page per proxy.
+        If there are not enough idle proxies, fewer pages are fetched, as a proxy that fails is released by the fetcher
+        and must not be in use by another page.
+
+    OUTPUT:
+        list of (page text, proxy it came through) in page order. The caller gives the leased proxies back
+    """
+    proxies = [private_proxy]
+    while len(proxies) < PAGE_PARALLEL_COUNT:
+        proxy = _PROXY_REGISTRY.get_nowait()
+        if not proxy:
+            break
+        proxies.append(proxy)
+    results = await asyncio.gather(*[proxy_fetcher(session, f"{user_info_url}&page={first_page + index}", proxy=proxy,
+                                                   endpoint="timeline page", headers=_MOBILE_HEADERS)
+                                     for index, proxy in enumerate(proxies)])
+    return list(results)
+
+
+def is_at_high_water_mark(card, high_water_mark):
+    """
+    DESCRIPTION:
+        check if a weibo has been scraped before, namely it is the high water mark or older than it
+
+    INPUT: 
+        card: ParsedCard of the weibo
+        high_water_mark: (url_id, timestamp) from the state store
+    """
+    mark_url_id, mark_timestamp = high_water_mark
+    if str(card.url_id) == mark_url_id:
+        return True
+    return card.timestamp is not None and card.timestamp < mark_timestamp
+
+
+async def get_rows_from_cards(private_proxy, session, cards, user_semaphore):
+    """
+    DESCRIPTION:
+        get the rows of the ParsedCards of a page. The detail pages of the truncated weibos are fetched at the same time,
+        the other cards, together with the truncated ones whose detail page failed, keep the row made from the card.
+
+    OUTPUT:
+        rows in card order without the cards that have no valid row, the proxy the worker should use next
+    """
+    # gather keeps the card order
+    detail_results = await asyncio.gather(*[fetch_detail_row(private_proxy, session, card.detail_href, user_semaphore)
+                                            for card in cards if card.detail_href])
+    private_proxy = settle_private_proxy(private_proxy, [proxy for _, proxy in detail_results])
+
+    detail_rows = iter([data_line for data_line, _ in detail_results])
+    rows = [(next(detail_rows) if card.detail_href else None) or card.data_line for card in cards]
+    return [data_line for data_line in rows if data_line], private_proxy
+
+
+def settle_private_proxy(private_proxy, used_proxies):
+    global _PROXY_REGISTRY
+    """
+    DESCRIPTION:
+        after the detail pages of a page have been fetched at the same time, several of them may have
+        switched to a new proxy. The worker keeps one of the new proxies and gives the others back.
+        A fetch only switches proxy after the worker's proxy failed or was outrun by a hedge. The fetches share
+        the worker's proxy and do not release it, so it is given back here, once, when the worker switches.
+
+    INPUT: 
+        private_proxy: the proxy of the worker before the detail pages were fetched
+        used_proxies: the proxies returned by the detail page fetches, None if a fetch ran out of retries
+
+    OUTPUT: 
+        the proxy the worker should use next, None if it should get a new one
+    """
+    new_proxies = {proxy for proxy in used_proxies if proxy and proxy != private_proxy}
+    if not new_proxies and None not in used_proxies:
+        return private_proxy
+    if private_proxy:
+        _PROXY_REGISTRY.release(private_proxy)
+    if not new_proxies:
+        return None
+    kept_proxy = new_proxies.pop()
+    for proxy in new_proxies:
+        _PROXY_REGISTRY.release(proxy)
+    return kept_proxy
+
+
+def get_proxy_semaphore(proxy_addr):
+    global _PROXY_SEMAPHORES, DETAIL_CONCURRENCY_PER_PROXY
+    if proxy_addr not in _PROXY_SEMAPHORES:
+        _PROXY_SEMAPHORES[proxy_addr] = asyncio.Semaphore(DETAIL_CONCURRENCY_PER_PROXY)
+    return _PROXY_SEMAPHORES[proxy_addr]
+
+
+def forget_proxy(proxy_addr):
+    global _RATE_LIMITER, _PROXY_SEMAPHORES
+    """
+    DESCRIPTION:
+        drop what is kept per proxy when the proxy is dropped from the registry, so it does not pile up over a long crawl
+    """
+    _RATE_LIMITER.forget(proxy_addr)
+    _PROXY_SEMAPHORES.pop(proxy_addr, None)
+
+
+def get_detail_href(card):
+    """
+    DESCRIPTION:
+        returns the href of the detail page if the text of the card is truncated with 全文, otherwise None
+    """
+    mblog = card.get("mblog")
+    if not mblog:
+        return None
+    weibo_text = mblog.get("text")
+    if not weibo_text or "全文" not in weibo_text:
+        return None
+    match = _HREF_PATTERN.search(weibo_text)
     if match:
-        href_value = match.group(1)
-        weibo_message_detail_page_url = f"https://m.weibo.cn/{href_value}"
-        weibo_messege_page_text, private_proxy = await proxy_fetcher(session, 
-                                                                     weibo_message_detail_page_url, 
-                                                                     proxy=private_proxy, 
-                                                                     headers=_MOBILE_HEADERS)
-        match = _DETAIL_PAGE_PATTERN.search(weibo_messege_page_text)
-        if match and len(match.group(1)) > 0:
-            weibo_messege_page_json = orjson.loads(match.group(1))
-            return get_row_from_mobile_data(weibo_messege_page_json["status"]), private_proxy
+        return match.group(1)
+    return None
+
+
+async def fetch_detail_row(private_proxy, session, href_value, user_semaphore):
+    with trace_span("detail page", href=href_value):
+        with trace_span("detail slot wait"):
+            await user_semaphore.acquire()
+        try:
+            async with get_proxy_semaphore(private_proxy):
+                return await _fetch_detail_row(private_proxy, session, href_value)
+        finally:
+            user_semaphore.release()
+
+
+async def _fetch_detail_row(private_proxy, session, href_value):
+    weibo_message_detail_page_url = f"{MWEIBO_BASE_URL}/{href_value.lstrip('/')}"
+    weibo_messege_page_text, private_proxy = await proxy_fetcher(session, 
+                                                                 weibo_message_detail_page_url, 
+                                                                 proxy=private_proxy, 
+                                                                 endpoint="detail page",
+                                                                 shared=True,
+                                                                 headers=_MOBILE_HEADERS)
+    if not weibo_messege_page_text:
+        return None, private_proxy
+    try:
+        return await parse_page(parse_detail_page, weibo_messege_page_text), private_proxy
+    except (TypeError, KeyError, AttributeError, orjson.JSONDecodeError) as e:
+        await append_new_line_to_log(f"detail page failed:: {type(e)}{e}:: {weibo_message_detail_page_url}", ERROR_LOG_NAME,
+                                     LOG_ERROR, rate_limit_key=f"detail error {type(e).__name__}")
+        ERRORS.inc("detail", type(e).__name__)
     return None, private_proxy
 
 
+async def parse_page(function, page_text):
+    global _OFFLOADER
+    """
+    DESCRIPTION:
+        parse a page with function, in the offload process pool while the event loop lags and on the loop otherwise
+    """
+    with trace_span("parse", function=function.__name__):
+        if _OFFLOADER is None:
+            return function(page_text)
+        return await _OFFLOADER.run(function, page_text)
+
+
+def parse_timeline_page(page_text):
+    """
+    DESCRIPTION:
+        parse a timeline page into what the walk needs of it. The rows are made here too,
+        so a page parsed in the offload process pool only sends back the small result instead of its json.
+
+    INPUT: 
+        the text of a getIndex timeline page
+
+    OUTPUT: 
+        since_id of the next page, list of ParsedCards of the cards in page order
+        data structure:
+            url_id, # weibo id, None if the card is not a weibo
+            is_top, # if the weibo is pinned
+            timestamp, # of created_at, None if it cannot be parsed
+            detail_href, # href of the detail page if the text is truncated with 全文, otherwise None
+            data_line # the row made from the card, None if it has no valid row
+    """
+    page_json = orjson.loads(page_text)
+    since_id = page_json['data']['cardlistInfo'].get('since_id')
+    raw_cards = page_json["data"]["cards"]
+    rows = get_rows_from_mobile_data([card.get("mblog") or card for card in raw_cards])
+    cards = []
+    for card, data_line in zip(raw_cards, rows):
+        mblog = card.get("mblog")
+        if mblog:
+            cards.append(ParsedCard(mblog.get("id"), bool(mblog.get("isTop")), get_timestamp_from_date_string(mblog.get("created_at")),
+                                    get_detail_href(card), data_line))
+        else:
+            cards.append(ParsedCard(None, False, None, None, data_line))
+    return since_id, cards
+
+
+def parse_detail_page(page_text):
+    """
+    DESCRIPTION:
+        get the row of the weibo of a detail page from the render data in its html
+
+    OUTPUT: 
+        the standerized list data for csv row, or None if the page has no render data
+    """
+    match = _DETAIL_PAGE_PATTERN.search(page_text)
+    if match and len(match.group(1)) > 0:
+        return get_row_from_mobile_data(orjson.loads(match.group(1))["status"])
+    return None
+
+
 def get_row_from_mobile_data(page_json):
-    global _WEIBO_DATE_FORMAT
     """
     DESCRIPTION:
-        formats mobile weibo data to standarized structure
+        formats mobile weibo data to standarized structure, see get_rows_from_mobile_data
 
     INPUT: 
         mobile weibo's mblog json dict
 
     OUTPUT: 
-        the standerized list data for csv row.
+        the standerized list data for csv row, or None if the mblog has no user or text
+    """
+    return get_rows_from_mobile_data([page_json])[0]
+
+
+def get_rows_from_mobile_data(page_jsons):
+    """
+    DESCRIPTION:
+        formats a batch of mobile weibo data to standarized structure
+
+    INPUT: 
+        list of mobile weibo's mblog json dicts
+
+    OUTPUT: 
+        list of the standerized list data for csv rows, in the same order as the input.
+        An mblog without user or text gives None.
         data structure:
             url_id, # weibo id
             text, # weibo text
@@ -354,122 +1014,427 @@ def get_row_from_mobile_data(page_json):
             date_string, # eg. Dec 27 14:55:18 +0800 2023
             timestamp
     """
+    rows = []
+    for page_json in page_jsons:
+        user_json = page_json.get("user")
+        raw_html = page_json.get("text")
+        if not user_json or not raw_html:
+            rows.append(None)
+            continue
+        text = extracted_text_from_html(raw_html)
+        date_string = page_json.get("created_at")
+        retweeted_status = page_json.get("retweeted_status")
+        rows.append([
+            page_json.get("id"), # weibo id
+            text, # weibo text
+            page_json.get("textLength") or len(text), # weibo text length
+            user_json.get("id"), # weibo owner
+            page_json.get("reposts_count"),
+            page_json.get("comments_count"),
+            page_json.get("attitudes_count"),
+            page_json.get("pic_num"),
+            ' '.join(page_json.get("pic_ids") or ()),
+            "retweeted_status" in page_json, # if this weibo is a retweet
+            retweeted_status.get("id") if retweeted_status else None, # if not, then None; if is, then id of the retweeted weibo
+            date_string, # eg. Dec 27 14:55:18 +0800 2023
+            get_timestamp_from_date_string(date_string)
+        ])
+    return rows
 
-    
-    
-    url_id = page_json.get("id")
-    user_json = page_json.get("user")
-    if not user_json:
-        return None
-    user_id = user_json.get("id")
-    raw_html = page_json.get("text")
-    if not raw_html:
-        return None
-    text = extracted_text_from_html(raw_html)
-    reposts_count = page_json.get("reposts_count")
-    comments_count = page_json.get("comments_count")
-    attitudes_count = page_json.get("attitudes_count")
-    text_length = page_json.get("textLength")
-    if not text_length:
-        text_length = len(text)
-    pic_num = page_json.get("pic_num")
-    pic_id = ' '.join(page_json.get("pic_ids"))
-    is_retweet = False
-    retweet_id = None
-    date_string = page_json.get("created_at")
-    timestamp = None
-    if date_string:
-        timestamp = int(datetime.strptime(date_string, _WEIBO_DATE_FORMAT).timestamp())
-    if "retweeted_status" in page_json:
-        is_retweet = True
-        retweet_id = page_json["retweeted_status"].get("id")
-    new_row = [
-                url_id, # weibo id
-                text, # weibo text
-                text_length, # weibo text length
-                user_id, # weibo owner
-                reposts_count,
-                comments_count,
-                attitudes_count,
-                pic_num,
-                pic_id,
-                is_retweet, # if this weibo is a retweet
-                retweet_id, # if not, then None; if is, then id of the retweeted weibo
-                date_string, # eg. Dec 27 14:55:18 +0800 2023
-                timestamp
-            ]
-    return new_row
-
-
-async def writer(results_queue: asyncio.Queue, csv_file):
-    global workers_still_working
-    # show results of the tasks as they arrive
-    fields = [
-                'url_id', # weibo id
-                'text', # weibo text
-                'text_length', # weibo text length
-                'user_id', # weibo owner
-                'reposts_count',
-                'comments_count',
-                'attitudes_count',
-                'pic_num',
-                'pic_id',
-                'is_retweet', # if this weibo is a retweet
-                'retweet_id', # if not, then None; if is, then id of the retweeted weibo
-                'date_string', # eg. Dec 27 14:55:18 +0800 2023
-                'timestamp'
-            ]
-    async with aiofiles.open(csv_file, 'w') as f:
-        writer = aiocsv.AsyncWriter(f)
-        await writer.writerow(fields)
-        while not (workers_still_working == 0 and results_queue.empty()):
+
+async def writer(job):
+    global _SEEN_IDS, OUTPUT_SINK, JOB_COMMIT_INTERVAL
+    """
+    Description:
+        This function writes the pages of rows from the results queue to the OUTPUT_SINK.
+        The JobResults and the HighWaterMarks of the finished users are collected, and every JOB_COMMIT_INTERVAL seconds
+        the sink commits its rows, then the users are marked in the job table and their high water marks are saved,
+        so neither moves past rows that have not been written.
+        The ids of the rows are added to the seen ids after they are written, so a crash cannot skip unwritten weibos next time.
+        Once the seen ids are full, no more ids are added to them and no weibos are skipped by them.
+
+    Life Cycle:
+        writer is started by his crawl job.
+        He gets off work when all the mweibo workers of the job have finished and the results queue is empty.
+        If he fails, his crawl job cancels the uid assigner and the workers.
+    """
+    results_queue = job.results_queue
+    # the rows of the uids the job table has marked done are not scraped again, so they are kept
+    sink = get_sink(OUTPUT_SINK, job.output_location, resume=job.job_table is not None)
+    await sink.open()
+    job_results = []
+    high_water_marks = []
+    last_job_commit = time.monotonic()
+    try:
+        while not (job.workers_still_working == 0 and results_queue.empty()):
             result = await results_queue.get()
-            if result:
-                await writer.writerows(result)
+            if isinstance(result, JobResult):
+                job_results.append(result)
+            elif isinstance(result, HighWaterMark):
+                high_water_marks.append(result)
+            elif result:
+                start_time = time.monotonic()
+                await sink.write_rows(result)
+                WRITE_SECONDS.observe(time.monotonic() - start_time)
+                ROWS.inc(amount=len(result))
+                if _SEEN_IDS is not None and not _SEEN_IDS.full:
+                    for data_line in result:
+                        _SEEN_IDS.add(data_line[0])
+                    if _SEEN_IDS.full:
+                        await log_seen_ids_full()
             results_queue.task_done()
+            if (job_results or high_water_marks) and time.monotonic() - last_job_commit >= JOB_COMMIT_INTERVAL:
+                await sink.commit()
+                await save_finished_users(job, job_results, high_water_marks)
+                job_results = []
+                high_water_marks = []
+                last_job_commit = time.monotonic()
+    finally:
+        await sink.close()
+    await save_finished_users(job, job_results, high_water_marks)
     
     print("writer jobs done")
-    await close_files()
 
 
-uid_assigner_work_done = False
-async def uid_assigner(id_queue: asyncio.Queue, uid_list):
-    global WORKER_SIZE, uid_assigner_work_done
+async def save_finished_users(job, job_results, high_water_marks):
+    global _STATE_STORE
+    """
+    DESCRIPTION:
+        mark the finished users in the job table and save their high water marks, after the sink has committed their rows
+    """
+    for mark in high_water_marks:
+        _STATE_STORE.set_high_water_mark(*mark)
+    if job_results:
+        await asyncio.to_thread(job.job_table.finish, job_results)
 
-    for uid in uid_list:
-        await id_queue.put(uid)
-    for _ in range(WORKER_SIZE):
-        await id_queue.put(False)
-    uid_assigner_work_done = True
+
+async def log_seen_ids_full():
+    global _SEEN_IDS, ERROR_LOG_NAME
+    await append_new_line_to_log(f"the seen id filter is full with {_SEEN_IDS.count} ids, weibos are no longer skipped by it. "
+                                 "Start a new SEEN_ID_FILE with a larger SEEN_ID_CAPACITY", ERROR_LOG_NAME, LOG_WARNING)
+
+
+async def uid_assigner(job):
+    global SCHEDULE_WINDOW
+    """
+    Description:
+        This function feeds the uids from the async uid source to the id queue.
+        The source is read SCHEDULE_WINDOW uids at a time, and the uids of a window are fed longest timeline first,
+        by the post counts in the user index (longest processing time first). So the heavy users start while
+        every worker is busy, instead of keeping a few workers, and their proxies, busy alone at the end of the crawl.
+        Every worker has its own proxy, so the heavy users started together are spread over the proxies.
+        The first window is one uid per worker, so the workers start right away, and every window is twice as large
+        as the one before, up to SCHEDULE_WINDOW.
+        A source yields None before it waits, eg. the job table for the leases of other processes,
+        and the uids of the window are fed right away then, as the other processes may be waiting for them.
+
+    Life Cycle:
+        uid assigner is started by his crawl job.
+        He gets off work after sending one None sign per worker of the job. If he fails, his crawl job cancels the workers.
+    """
+
+    window = []
+    window_size = min(job.worker_size, SCHEDULE_WINDOW)
+    async for uid in job.uid_source:
+        if uid is None:
+            await assign_window(job.id_queue, window)
+            window = []
+            continue
+        window.append(uid)
+        if len(window) >= window_size:
+            await assign_window(job.id_queue, window)
+            window = []
+            window_size = min(window_size * 2, SCHEDULE_WINDOW)
+    await assign_window(job.id_queue, window)
+    for _ in range(job.worker_size):
+        await job.id_queue.put(False)
+    job.uid_assigner_work_done = True
     print("uid assigner work done")
 
 
-async def initiator(worker_size, uid_list, csv_file_location):
-    id_queue = asyncio.Queue(worker_size * 20)
-    results_queue = asyncio.Queue()
-    
-    mobile_weibo_workers = []
-    for _ in range(worker_size):
-        mobile_weibo_workers.append(asyncio.create_task(mweibo_worker(id_queue, results_queue)))
-    
-    await asyncio.gather(proxy_boss(), 
-                        uid_assigner(id_queue, uid_list), 
-                        writer(results_queue, csv_file_location), 
-                        *mobile_weibo_workers)
+async def assign_window(id_queue: asyncio.Queue, window):
+    global _STATE_STORE, USER_INDEX_TTL, SCHEDULE_UNKNOWN_POST_COUNT
+    """
+    DESCRIPTION:
+        put the uids of a window to the id queue, the ones with the most posts first.
+        The sort is stable, so the users without a known post count keep the order of the source
+    """
+    if len(window) > 1 and USER_INDEX_TTL:
+        post_counts = _STATE_STORE.get_post_counts(window, USER_INDEX_TTL)
+        window.sort(key=lambda uid: post_counts.get(uid, SCHEDULE_UNKNOWN_POST_COUNT), reverse=True)
+    for uid in window:
+        await id_queue.put(uid)
+
+
+async def job_lease_keeper(job_table):
+    global JOB_LEASE_SECONDS
+    """
+    Description:
+        This function renews the leases of the uids claimed by this process every third of JOB_LEASE_SECONDS,
+        so the uids waiting in the id queue and the users with long timelines are not handed out again.
+
+    Life Cycle:
+        lease keeper is started by the crawl job and cancelled when the job is done.
+    """
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        await asyncio.to_thread(job_table.renew)
+
 
+class CrawlJob:
+    """
+    Description:
+        This is one crawl of a scraper engine: the uids of uid_source are scraped by worker_size mweibo workers
+        and written to output_location by the writer. The crawl jobs of an engine share its proxies, identities
+        and connections, and each one has its own queues, uid assigner, workers, writer and job table.
+
+    DATA STRUCTURE:
+        uid_source, # async iterable of uids, claimed from the job table if there is one
+        output_location, # where the sink writes, the sink adds the extension
+        worker_size,
+        workers_still_working, # the writer gets off work when it is 0 and the results queue is empty
+        uid_assigner_work_done,
+        job_table, # JobTable of job_db_file, or None
+        id_queue,
+        results_queue
+
+    Life Cycle:
+        crawl jobs are created and started by ScraperEngine.add_job, and waited for by ScraperEngine.stop.
+    """
+
+    def __init__(self, uid_source, output_location, worker_size, job_db_file=None):
+        global RESULTS_QUEUE_SIZE
+        self.output_location = output_location
+        self.worker_size = worker_size
+        self.workers_still_working = worker_size
+        self.uid_assigner_work_done = False
+        self.job_table = None
+        if job_db_file:
+            # the uids are added to the job table and claimed from it, so a crawl can be resumed
+            self.job_table = JobTable(job_db_file)
+            uid_source = job_uid_source(self.job_table, uid_source)
+        self.uid_source = uid_source
+        self.id_queue = asyncio.Queue(worker_size * 20)
+        self.results_queue = asyncio.Queue(RESULTS_QUEUE_SIZE)
+        self._assigner = None
+        self._writer = None
+        self._workers = []
+        self._lease_keeper = None
+
+    def start(self):
+        if self.job_table:
+            self._lease_keeper = asyncio.create_task(job_lease_keeper(self.job_table))
+        self._assigner = asyncio.create_task(uid_assigner(self))
+        self._writer = asyncio.create_task(writer(self))
+        self._workers = [asyncio.create_task(mweibo_worker(self)) for _ in range(self.worker_size)]
+        self._assigner.add_done_callback(self._assigner_done)
+        self._writer.add_done_callback(self._writer_done)
+
+    def _assigner_done(self, assigner):
+        # if the uid source fails, eg. the user index file is missing, no None signs are sent
+        # and the workers would wait for uids forever. They are cancelled, so wait() raises the error
+        if not assigner.cancelled() and assigner.exception() is not None:
+            for task in self._workers:
+                task.cancel()
+
+    def _writer_done(self, writer_task):
+        # if the sink fails, eg. the disk is full, the workers would wait for room in the results queue forever
+        if not writer_task.cancelled() and writer_task.exception() is not None:
+            self.cancel()
 
-def get_uid_list(range_from, range_to, limit):
-    db_file = "/media/scott/ScottTang/backup/weibo.db"
-    table_name = "weibo_phone"
-    sql_fetch_all_uid = f"SELECT uid FROM {table_name} WHERE uid BETWEEN {range_from} AND {range_to} LIMIT {limit}"
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute(sql_fetch_all_uid)
-    return [row[0] for row in cursor.fetchall()]
+    def done(self):
+        return self._writer is not None and self._writer.done()
+
+    def cancel(self):
+        """
+        DESCRIPTION:
+            stop handing out uids and get the workers off work. The writer is not cancelled,
+            he writes the rows already in the results queue and gets off work after the last worker.
+            The unfinished uids stay leased in the job table, so a later crawl picks them up again
+        """
+        for task in [self._assigner] + self._workers:
+            task.cancel()
+
+    async def wait(self):
+        """
+        DESCRIPTION:
+            wait until the writer has got off work, then stop the lease keeper and close the job table.
+            The first error of the uid assigner, the workers or the writer is raised
+        """
+        try:
+            results = await asyncio.gather(self._assigner, self._writer, *self._workers, return_exceptions=True)
+        finally:
+            if self._lease_keeper:
+                self._lease_keeper.cancel()
+                await asyncio.gather(self._lease_keeper, return_exceptions=True)
+            if self.job_table:
+                self.job_table.close()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+
+class ScraperEngine:
+    """
+    Description:
+        This is the scraper as an object that can be embedded in another asyncio program.
+        The engine owns what its crawl jobs share: the proxy boss (or the proxy broker client) and the proxy registry,
+        the identity warmers and the identity pool, the connection pool, the state store, the seen ids, the metrics,
+        the loop lag monitor, the offload process pool and the tracer.
+        Several crawl jobs, eg. different uid ranges or outputs, run on one engine at the same time in one event loop.
+        The settings are read from weibo_scraper_settings as before, so only one engine runs in a process at a time,
+        start raises a RuntimeError while another engine runs.
+
+    Life Cycle:
+        await engine.start(), then engine.add_job() for every crawl, and await engine.stop(), which waits for the jobs.
+        async with ScraperEngine() as engine: ... does the same, and cancels the jobs if the block raises.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._proxy_task = None
+        self._background_tasks = []
+        self._metrics_runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.stop(cancel=exc_type is not None)
+
+    async def start(self):
+        global _PROXY_REGISTRY, _UNCHECKED_PROXY_QUEUE, _PROXY_CHECK_SEMAPHORE, _PROXY_SEMAPHORES, _RATE_LIMITER, _HEDGE_POLICY, \
+            _IDENTITY_POOL, _STATE_STORE, _SEEN_IDS, _LAG_MONITOR, _OFFLOADER, _TRACER, PROXY_CHECKER_COUNT, IDENTITY_POOL_SIZE, IDENTITY_WARMER_COUNT, \
+            STATE_DB_FILE, STATE_COMMIT_INTERVAL, SEEN_ID_CAPACITY, SEEN_ID_ERROR_RATE, SEEN_ID_FILE, PROXY_BROKER_URL, \
+            METRICS_HOST, METRICS_PORT, METRICS_INTERVAL, METRICS_SNAPSHOT_NAME, LOOP_LAG_INTERVAL, OFFLOAD_PROCESSES, \
+            OFFLOAD_LAG_THRESHOLD, OFFLOAD_BATCH_SIZE, OFFLOAD_BATCH_DELAY, TRACE_FILE, TRACE_FORMAT, TRACE_SAMPLE_RATE, TRACE_SLOW_USER_SECONDS, \
+            _RUNNING_ENGINE
+        # the engines share the module globals, a second one would take over the proxies and the stores of the first
+        if _RUNNING_ENGINE is not None:
+            raise RuntimeError("a scraper engine is already running in this process, add the crawl as a job of it")
+        # a previous engine of this process may have left proxies leased or identities closed
+        _RATE_LIMITER = AdaptiveRateLimiter()
+        _PROXY_REGISTRY = ProxyRegistry(on_remove=forget_proxy)
+        _UNCHECKED_PROXY_QUEUE = asyncio.Queue()
+        _PROXY_CHECK_SEMAPHORE = asyncio.Semaphore(PROXY_CHECKER_COUNT)
+        _PROXY_SEMAPHORES = {}
+        _HEDGE_POLICY = HedgePolicy()
+        _IDENTITY_POOL = IdentityPool(IDENTITY_POOL_SIZE)
+        _STATE_STORE = StateStore(STATE_DB_FILE, STATE_COMMIT_INTERVAL)
+        _SEEN_IDS = BloomFilter(SEEN_ID_CAPACITY, SEEN_ID_ERROR_RATE, SEEN_ID_FILE) if SEEN_ID_CAPACITY else None
+        if _SEEN_IDS is not None and _SEEN_IDS.full:
+            await log_seen_ids_full()
+        _LAG_MONITOR = LoopLagMonitor(LOOP_LAG_INTERVAL) if LOOP_LAG_INTERVAL else None
+        _OFFLOADER = None
+        if _LAG_MONITOR and OFFLOAD_PROCESSES:
+            _OFFLOADER = ParseOffloader(_LAG_MONITOR, OFFLOAD_PROCESSES, OFFLOAD_LAG_THRESHOLD, OFFLOAD_BATCH_SIZE, OFFLOAD_BATCH_DELAY)
+        _TRACER = Tracer(TRACE_FILE, TRACE_FORMAT, TRACE_SAMPLE_RATE, TRACE_SLOW_USER_SECONDS)
+
+        # a full id queue means the workers are the bottleneck, a full results queue means the writer is
+        QUEUE_DEPTH.set_function(_PROXY_REGISTRY.qsize, "checked proxies")
+        QUEUE_DEPTH.set_function(_UNCHECKED_PROXY_QUEUE.qsize, "unchecked proxies")
+        QUEUE_DEPTH.set_function(lambda: sum(job.id_queue.qsize() for job in self.jobs), "id")
+        QUEUE_DEPTH.set_function(lambda: sum(job.results_queue.qsize() for job in self.jobs), "results")
+        QUEUE_DEPTH.set_function(_IDENTITY_POOL.qsize, "identities")
+        if METRICS_PORT is not None:
+            # the metrics are not worth failing the crawl for
+            try:
+                self._metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+            except OSError as e:
+                await append_new_line_to_log(f"metrics are not served, {METRICS_HOST}:{METRICS_PORT} cannot be bound: {e}",
+                                             ERROR_LOG_NAME, LOG_WARNING)
+        snapshot_file = LOG_OUTPUT_FOLDER + METRICS_SNAPSHOT_NAME if METRICS_SNAPSHOT_NAME else None
+
+        # the shards of weibo_scraper_launcher share the proxies checked by the proxy broker
+        self._proxy_task = asyncio.create_task(proxy_broker_client() if PROXY_BROKER_URL else proxy_boss())
+        self._background_tasks = [self._proxy_task, asyncio.create_task(metrics_reporter(METRICS_INTERVAL, snapshot_file))]
+        self._background_tasks += [asyncio.create_task(identity_warmer()) for _ in range(IDENTITY_WARMER_COUNT)]
+        if _LAG_MONITOR:
+            self._background_tasks.append(asyncio.create_task(_LAG_MONITOR.run()))
+        if TRACE_FILE:
+            self._background_tasks.append(asyncio.create_task(_TRACER.run()))
+        _RUNNING_ENGINE = self
+
+    def add_job(self, uid_source, output_location, worker_size=None, job_db_file=None):
+        global WORKER_SIZE, JOB_DB_FILE
+        """
+        DESCRIPTION:
+            start a crawl job on the engine
+
+        INPUT:
+            uid_source, # async iterable of uids
+            output_location, # where the sink writes, the sink adds the extension
+            worker_size, # the amount of mweibo workers of the job, None for WORKER_SIZE
+            job_db_file # the job table of the job, None for JOB_DB_FILE
+
+        OUTPUT:
+            the started CrawlJob
+        """
+        job = CrawlJob(uid_source, output_location, worker_size or WORKER_SIZE, job_db_file or JOB_DB_FILE)
+        job.start()
+        self.jobs.append(job)
+        return job
+
+    async def stop(self, cancel=False):
+        global _PROXY_REGISTRY, _IDENTITY_POOL, _STATE_STORE, _SEEN_IDS, _OFFLOADER, _RUNNING_ENGINE
+        """
+        DESCRIPTION:
+            wait for the crawl jobs to finish, get everyone of the engine off work and close what the engine owns.
+            If cancel, the jobs are cancelled first, and the rows their workers have fetched are still written.
+            If the proxy boss fails, the jobs are cancelled as well and his error is raised.
+            If stop itself is cancelled, the writers are cancelled too and their sinks are closed.
+        """
+        if cancel:
+            for job in self.jobs:
+                job.cancel()
+        jobs_done = asyncio.ensure_future(asyncio.gather(*[job.wait() for job in self.jobs], return_exceptions=True))
+        try:
+            await asyncio.wait([jobs_done, self._proxy_task], return_when=asyncio.FIRST_COMPLETED)
+            if not jobs_done.done():
+                # the workers would wait for proxies forever
+                for job in self.jobs:
+                    job.cancel()
+            errors = [result for result in await jobs_done if isinstance(result, Exception)]
+        finally:
+            if not jobs_done.done():
+                jobs_done.cancel()
+                await asyncio.gather(jobs_done, return_exceptions=True)
+            for task in self._background_tasks:
+                task.cancel()
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+            if _OFFLOADER:
+                _OFFLOADER.close()
+            for proxy in await _IDENTITY_POOL.close():
+                _PROXY_REGISTRY.release(proxy)
+            if self._metrics_runner:
+                await self._metrics_runner.cleanup()
+            _STATE_STORE.close()
+            if _SEEN_IDS is not None:
+                _SEEN_IDS.close()
+            await get_shared_connector().close()
+            await close_files()
+            _RUNNING_ENGINE = None
+        if self._proxy_task.done() and not self._proxy_task.cancelled() and self._proxy_task.exception():
+            raise self._proxy_task.exception()
+        if errors:
+            raise errors[0]
+
+
+async def initiator(worker_size, uid_source, output_location):
+    """
+    DESCRIPTION:
+        scrape the uids of uid_source with a scraper engine of one crawl job
+    """
+    engine = ScraperEngine()
+    await engine.start()
+    engine.add_job(uid_source, output_location, worker_size)
+    await engine.stop()
 
 
 if __name__ == '__main__':
 
-    csv_output = f"{CSV_OUTPUT_FOLDER}weibo_final_{RANGE_FROM}.csv"
-    uid_list = get_uid_list(RANGE_FROM, RANGE_TO, LIMIT)
-    asyncio.run(initiator(WORKER_SIZE, uid_list, csv_output))
\ No newline at end of file
+    # the output sink adds the extension
+    output_location = f"{CSV_OUTPUT_FOLDER}weibo_final_{RANGE_FROM}"
+    uid_source = get_uid_source(RANGE_FROM, RANGE_TO, LIMIT)
+    asyncio.run(initiator(WORKER_SIZE, uid_source, output_location))
\ No newline at end of file